@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+##
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Circuit breaker for calls to github, shared by all instances through memcache.
+
+Calls that fail, or take longer than config.github_circuit_slow_call, count
+against github.  Once config.github_circuit_failures of them land within
+config.github_circuit_window seconds the circuit opens, and calls fail fast
+with CircuitOpenError for config.github_circuit_cooldown seconds.  After that
+one probe call per cooldown is let through, and the circuit closes again as
+soon as one succeeds.
+"""
+
+import logging
+from google.appengine.api import memcache
+import config
+
+OPEN_KEY = 'github-circuit:open'
+HALF_OPEN_KEY = 'github-circuit:half-open'
+PROBE_KEY = 'github-circuit:probe'
+FAILURES_KEY = 'github-circuit:failures'
+
+
+class CircuitOpenError(Exception):
+    """Github has been failing, so we aren't calling it right now."""
+    pass
+
+
+def is_open():
+    return memcache.get(OPEN_KEY) is not None
+
+
+# check the circuit before calling github, returns True if the call is the probe for a half open
+# circuit and raises CircuitOpenError if the call shouldn't be made at all
+def before_call():
+    state = memcache.get_multi([OPEN_KEY, HALF_OPEN_KEY])
+    if OPEN_KEY in state:
+        raise CircuitOpenError()
+    if HALF_OPEN_KEY in state:
+        # only one caller per cooldown gets to find out if github is back
+        if not memcache.add(PROBE_KEY, True, config.github_circuit_cooldown):
+            raise CircuitOpenError()
+        return True
+    return False
+
+
+# count a call against the circuit, once it's done
+def after_call(probe, ok, elapsed):
+    if ok and elapsed > config.github_circuit_slow_call:
+        logging.info("github took %.1f seconds to answer." % elapsed)
+        ok = False
+
+    if ok:
+        if probe:
+            logging.info("github is back, closing the circuit.")
+            memcache.delete_multi([HALF_OPEN_KEY, PROBE_KEY, FAILURES_KEY])
+        return
+
+    if probe:
+        trip()
+        return
+
+    memcache.add(FAILURES_KEY, 0, config.github_circuit_window)
+    failures = memcache.incr(FAILURES_KEY, initial_value=0)
+    if failures >= config.github_circuit_failures:
+        trip()
+
+
+def trip():
+    logging.warning("github is failing, opening the circuit for %s seconds." % config.github_circuit_cooldown)
+    memcache.set(OPEN_KEY, True, config.github_circuit_cooldown)
+    memcache.set(HALF_OPEN_KEY, True)
+    memcache.delete_multi([PROBE_KEY, FAILURES_KEY])
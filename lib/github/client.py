@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+##
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Shared HTTP client for the Github API.
+
+Every call goes out through the URL Fetch service, which keeps the connections
+to github warm between requests, with a bounded deadline for the kind of call
+it is and gzip'd responses.  The rate limit github reports back is recorded
+for each credential as we go, and every call goes through the circuit breaker,
+so these raise circuit.CircuitOpenError while github is down.
+"""
+
+import zlib, time
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+import lib.github.ratelimit as ratelimit
+import lib.github.circuit as circuit
+
+# seconds we'll wait on github for each kind of call
+READ_DEADLINE = 10
+LIST_DEADLINE = 30
+WRITE_DEADLINE = 20
+
+DEFAULT_HEADERS = {
+    'Accept-Encoding': 'gzip',
+    'User-Agent': 'StackGeek',
+}
+
+
+class Response(object):
+    """
+    A github response, with the body already un-gzip'd.
+    """
+
+    def __init__(self, result):
+        self.status_code = result.status_code
+        self.headers = result.headers
+        self.content = result.content
+        if self.content and self.headers.get('Content-Encoding') == 'gzip':
+            self.content = zlib.decompress(self.content, 16 + zlib.MAX_WBITS)
+
+
+def build_headers(headers=None):
+    request_headers = dict(DEFAULT_HEADERS)
+    request_headers.update(headers or {})
+    return request_headers
+
+
+# make a blocking call to github
+def request(uri, method='GET', body=None, headers=None, deadline=READ_DEADLINE):
+    probe = circuit.before_call()
+    started = time.time()
+    try:
+        result = urlfetch.fetch(uri, payload=body, method=method, headers=build_headers(headers), deadline=deadline, validate_certificate=True)
+    except:
+        circuit.after_call(probe, False, time.time() - started)
+        raise
+
+    circuit.after_call(probe, result.status_code < 500, time.time() - started)
+    ratelimit.record(uri, result.headers)
+    return Response(result)
+
+
+# start a call for each of {name: uri} at once, returning {name: rpc} to wait on with get_result
+def request_async(uris, deadline=READ_DEADLINE, headers=None):
+    headers = headers or {}
+    probe = circuit.before_call()
+    started = time.time()
+    rpcs = {}
+    for name, uri in uris.items():
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, uri, method=urlfetch.GET, headers=build_headers(headers.get(name)), validate_certificate=True)
+        # hang on to what get_result needs to know about the call
+        rpc.uri = uri
+        rpc.probe = probe
+        rpc.started = started
+        rpcs[name] = rpc
+    return rpcs
+
+
+def get_result(rpc):
+    try:
+        result = rpc.get_result()
+    except:
+        circuit.after_call(rpc.probe, False, time.time() - rpc.started)
+        raise
+
+    circuit.after_call(rpc.probe, result.status_code < 500, time.time() - rpc.started)
+    ratelimit.record(rpc.uri, result.headers)
+    return Response(result)
+
+
+# get_result for use in a tasklet, so datastore work can carry on while the call is out
+@ndb.tasklet
+def get_result_async(rpc):
+    try:
+        yield rpc
+    except Exception:
+        # get_result raises it again once the circuit has heard about it
+        pass
+    raise ndb.Return(get_result(rpc))
@@ -17,10 +17,17 @@ __author__ = 'Kord Campbell'
 __website__ = 'http://www.tinyprobe.com'
 
 import config
-import urllib, httplib2, simplejson, yaml
+import urllib, simplejson, yaml, time, hashlib
 import lib.github.oauth_client as oauth2
+import lib.github.client as client
+import lib.github.ratelimit as ratelimit
+import lib.github.circuit as circuit
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+import web.models.models as models
 import logging
+import bleach
 
 # mark up, down, left, right
 from lib.markdown import markdown
@@ -87,103 +94,599 @@ class GithubAuth(object):
         return simplejson.loads(body)
 
 
-def get_user_gists(github_user, access_token):
-    params = {'access_token': access_token}
-    base_uri = 'https://api.github.com/users/%s/gists?client_id=%s&client_secret=%s' % (github_user, config.github_client_id, config.github_client_secret) 
+class GistFetchError(Exception):
+    """Github couldn't hand over a gist listing or file just now, which says nothing about the gists themselves."""
+    pass
+
+
+# gists github lists per page, which it caps at 100
+GISTS_PER_PAGE = 100
+
+
+# one page of a user's gist listing, returns (gists, more) with the gists as github lists them, which
+# leaves out the file contents, and whether there's another page.  raises GistFetchError if github
+# couldn't be asked.  since is a datetime, for only listing the gists updated after it
+def list_user_gists(github_user, access_token, page=1, since=None):
+    params = {'access_token': access_token, 'client_id': config.github_client_id, 'client_secret': config.github_client_secret, 'page': page, 'per_page': GISTS_PER_PAGE}
+    if since:
+        params['since'] = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+    base_uri = 'https://api.github.com/users/%s/gists' % github_user
     uri = '%s?%s' % (base_uri, urllib.urlencode(params))
-    
+
     try:
         # request data from github gist API
-        http = httplib2.Http(cache=None, timeout=None, proxy_info=None)
-        headers, content = http.request(uri, method='GET', body=None, headers=None)
-        gists = simplejson.loads(content)
+        response = client.request(uri, deadline=client.LIST_DEADLINE)
+    except:
+        raise GistFetchError("couldn't list page %s of the gists of %s." % (page, github_user))
 
-        # transform gists into articles
-        articles = []
-        for gist in gists:
-            try:
-                # grab the raw file and parse it for yaml bits
-                if gist['files'][config.gist_manifest_name]['raw_url']:
-                    headers, content = http.request(gist['files'][config.gist_manifest_name]['raw_url'])
-                    manifest = yaml.load(content)
-
-                # stuff it onto article list
-                articles.append({
-                    'title': manifest['title'], 
-                    'summary': manifest['summary'], 
-                    'published': manifest['published'],
-                    'article_type': manifest['type'],
-                    'gist_id': gist['id'],
-                })
-            
-            except:
-                # gist didn't have a .manifest file - so sad
-                pass
+    if response.status_code == 404:
+        # they're not on github under that name any more, so there's nothing to list
+        logging.info("github doesn't know %s." % github_user)
+        return [], False
+    if response.status_code != 200:
+        raise GistFetchError("github sent back a %s for page %s of the gists of %s." % (response.status_code, page, github_user))
+
+    try:
+        gists = simplejson.loads(response.content)
+    except ValueError:
+        raise GistFetchError("github sent back a listing of the gists of %s we couldn't read." % github_user)
 
-        return articles
+    return gists, 'rel="next"' in response.headers.get('Link', '')
 
+
+# the gists in a listing that changed since we last saw them, known is {gist_id: updated_at}
+# for the gists we already have
+def changed_gists(gists, known=None):
+    known = known or {}
+    return [gist for gist in gists if gist['id'] not in known or known[gist['id']] != gist.get('updated_at')]
+
+
+# read a gist's manifest into the article fields we keep, None if it doesn't have one we can read.
+# manifest_file is the manifest's entry in the gist's files.  raises GistFetchError when github
+# couldn't be asked for it, so the caller can try again rather than take that as no manifest
+def get_gist_article(gist_id, updated_at, manifest_file):
+    content = manifest_file.get('content')
+    if is_truncated(manifest_file):
+        # gist listings leave out contents, so it's a trip to the raw file
+        try:
+            response = client.request(manifest_file['raw_url'])
+        except:
+            raise GistFetchError("couldn't fetch the manifest of gist %s." % gist_id)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise GistFetchError("github sent back a %s for the manifest of gist %s." % (response.status_code, gist_id))
+        content = response.content
+
+    try:
+        # parse the manifest file for yaml bits
+        manifest = yaml.load(content)
+
+        return {
+            'title': manifest['title'], 
+            'summary': manifest['summary'], 
+            'published': manifest['published'],
+            'article_type': manifest['type'],
+            'gist_id': gist_id,
+            'updated_at': updated_at,
+        }
     except:
+        # gist didn't have a .manifest file - so sad
+        return None
+
+
+# pull the revision github assigned to the latest edit of a gist
+def get_gist_revision(gist):
+    try:
+        return gist['history'][0]['version']
+    except (KeyError, IndexError, TypeError):
+        return gist.get('updated_at')
+
+
+# the gists api sends file contents inline, unless the file is too big and it got cut short
+def is_truncated(gist_file):
+    return gist_file.get('truncated') or gist_file.get('content') is None
+
+
+# get a gist file's contents, only going to its raw_url when they weren't sent inline
+def get_gist_file_content(gist_file):
+    if not is_truncated(gist_file):
+        return gist_file['content']
+    return client.request(gist_file['raw_url']).content
+
+
+# find the .md or .rst file in a gist matching our filenames in config
+def get_gist_file(gist):
+    for filename in (config.gist_markdown_name, config.gist_restructuredtext_name):
+        if filename in gist['files']:
+            return filename, gist['files'][filename]
+    return None, None
+
+
+# render the contents of a gist's .md or .rst file into html
+def render_gist_file(filename, content):
+    if filename == config.gist_markdown_name:
+        return markdown.markdown(content)
+    else:
+        parts = publish_parts(source=content, writer_name='html4css1', settings_overrides={'title': '', 'report_level': 'quiet', '_disable_config': True})
+        return parts['html_body'].replace('class="docinfo"', 'class="table table-striped"').replace('class="docutils', 'class="table table-striped table-bordered')
+
+
+# hash of the bleach whitelist, so html sanitized under an older whitelist is never served
+def get_whitelist_hash():
+    whitelist = simplejson.dumps([sorted(config.bleach_tags), config.bleach_attributes], sort_keys=True)
+    return hashlib.md5(whitelist).hexdigest()[:8]
+
+
+# memcache holds the sanitized html, keyed by the whitelist it was sanitized with
+def content_key(gist_id, whitelist):
+    return '%s:content:%s' % (gist_id, whitelist)
+
+
+# reasons we couldn't render a gist, negatively cached for config.gist_negative_cache_time
+GIST_NOT_FOUND = 'not_found'
+GIST_NO_CONTENT = 'no_content'
+GIST_RENDER_ERROR = 'render_error'
+GIST_UPSTREAM_ERROR = 'upstream_error'
+
+
+def missing_key(gist_id):
+    return '%s:missing' % gist_id
+
+
+# look up why gists couldn't be rendered recently, returns {gist_id: reason} for the broken ones
+def get_gist_failures(gist_ids):
+    failures = memcache.get_multi([missing_key(gist_id) for gist_id in gist_ids])
+    return dict((gist_id, failures[missing_key(gist_id)]) for gist_id in gist_ids if missing_key(gist_id) in failures)
+
+
+# stored is {gist_id: stored render or None} for the gists that were fetched.  an old render beats no
+# render, so a failure that was github's doesn't get cached over a render readers can still have
+def cache_gist_failures(failures, stored=None):
+    stored = stored or {}
+    failures = dict((gist_id, reason) for gist_id, reason in failures.items() if not (stored.get(gist_id) and reason == GIST_UPSTREAM_ERROR))
+    if failures:
+        memcache.set_multi(dict((missing_key(gist_id), reason) for gist_id, reason in failures.items()), config.gist_negative_cache_time)
+
+
+# sanitize javascript out of a stored render, unless it was already done with this whitelist
+def sanitize_rendered(rendered, whitelist):
+    if rendered.sanitized is not None and rendered.whitelist == whitelist:
+        return False
+    rendered.sanitized = bleach.clean(rendered.html, config.bleach_tags, config.bleach_attributes)
+    rendered.whitelist = whitelist
+    return True
+
+
+def gist_url(gist_id):
+    return 'https://api.github.com/gists/%s?client_id=%s&client_secret=%s' % (gist_id, config.github_client_id, config.github_client_secret)
+
+
+# conditional request headers, so github can tell us a stored render is still current
+def revalidation_headers(rendered):
+    headers = {}
+    if rendered and rendered.etag:
+        headers['If-None-Match'] = rendered.etag
+    if rendered and rendered.last_modified:
+        headers['If-Modified-Since'] = rendered.last_modified
+    return headers
+
+
+# queue a background refresh of a stale render, named so there's only ever one per stored copy
+# refreshes get spaced out as the app's rate limit runs low, see ratelimit.get_background_delay
+def gist_refresh_task(gist_id, rendered=None, countdown=None):
+    task_name = None
+    if rendered:
+        task_name = 'gist-%s-%s' % (gist_id, rendered.get_rendered_at().strftime('%s'))
+    if countdown is None:
+        countdown = ratelimit.get_background_delay()
+    params = {'gist_id': gist_id, 'job_token': config.job_token}
+    return taskqueue.Task(name=task_name, method='GET', url='/blog/refreshgist/', params=params, countdown=countdown)
+
+
+def queue_gist_refresh(gist_id, rendered=None, countdown=None):
+    try:
+        taskqueue.Queue('gists').add(gist_refresh_task(gist_id, rendered, countdown))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
         pass
-        # TODO do somthing if getting the gists fails
+
+
+# batch version of queue_gist_refresh for stored renders, the task queue takes 100 at a time
+def queue_gist_refreshes(renders):
+    countdown = ratelimit.get_background_delay()
+    tasks = [gist_refresh_task(rendered.key.id(), rendered, countdown) for rendered in renders]
+    for i in range(0, len(tasks), 100):
+        try:
+            # tasks that are already queued are skipped, the rest still go in
+            taskqueue.Queue('gists').add(tasks[i:i + 100])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
 
 
 # fetch either .md or .rst files from github and render into html, caching as needed
 def get_gist_content(gist_id):
-    content = memcache.get('%s:content' % gist_id)
-    if content is not None:
-        return content
-    else:
-        logging.info("Got a cache miss for %s." % gist_id)
+    return get_gist_content_async(gist_id).get_result()
+
+
+@ndb.tasklet
+def get_gist_content_async(gist_id):
+    contents = yield get_gist_contents_async([gist_id])
+    raise ndb.Return(contents.get(gist_id, False))
+
+
+def get_gist_contents(gist_ids):
+    return get_gist_contents_async(gist_ids).get_result()
+
+
+# batch version of get_gist_content, returns {gist_id: html} with False for gists we couldn't render
+# gists that recently failed to render are skipped until their negative cache entry runs out, though
+# when that was github's fault we still serve any stored render, and just don't ask github again
+# the html is sanitized before it is cached, so readers never have to run bleach on it
+# memcache sits in front of a RenderedArticle copy in the datastore, and we only go to github for
+# gists we've never rendered or whose stored copy is past config.gist_max_stale_time - anything
+# less stale than that gets served as is, with a task queued to refresh it in the background
+# it's a tasklet, so a handler can have its own datastore lookups going while this waits on github
+@ndb.tasklet
+def get_gist_contents_async(gist_ids):
+    gist_ids = list(set(gist_ids))
+    contents = dict((gist_id, False) for gist_id in gist_ids)
+    whitelist = get_whitelist_hash()
+
+    # one trip to memcache for both the content and the negative cache
+    keys = [content_key(gist_id, whitelist) for gist_id in gist_ids] + [missing_key(gist_id) for gist_id in gist_ids]
+    cached = memcache.get_multi(keys)
+    misses = []
+    upstream_failed = set()
+    for gist_id in gist_ids:
+        if content_key(gist_id, whitelist) in cached:
+            contents[gist_id] = cached[content_key(gist_id, whitelist)]
+        elif missing_key(gist_id) not in cached:
+            misses.append(gist_id)
+        elif cached[missing_key(gist_id)] == GIST_UPSTREAM_ERROR:
+            misses.append(gist_id)
+            upstream_failed.add(gist_id)
+
+    if not misses:
+        raise ndb.Return(contents)
+
+    logging.info("Got a cache miss for %s." % ", ".join(misses))
+
+    # fall through to the stored renders before bothering github
+    to_cache = {}
+    to_fetch = {}
+    to_put = []
+    to_refresh = []
+    try:
+        stored = yield ndb.get_multi_async([ndb.Key(models.RenderedArticle, gist_id) for gist_id in misses])
+    except Exception:
+        # going to github for all of them instead would only pile onto whatever's wrong, so the page
+        # goes without these ones this time
+        logging.exception("couldn't read the stored renders of %s." % ", ".join(misses))
+        raise ndb.Return(contents)
+    for gist_id, rendered in zip(misses, stored):
+        if rendered and rendered.is_servable():
+            if not rendered.is_fresh():
+                logging.info("serving stale render of gist %s while it refreshes." % gist_id)
+                to_refresh.append(rendered)
+            if sanitize_rendered(rendered, whitelist):
+                to_put.append(rendered)
+            # stale ones only get cached briefly, so they can't outlive their servable window
+            contents[gist_id] = rendered.sanitized
+            to_cache[gist_id] = (rendered.sanitized, rendered.get_cache_time())
+        elif gist_id in upstream_failed:
+            # github just let us down on this one, so serve what we have without asking it again
+            if rendered:
+                logging.info("serving old render of gist %s while github is having trouble." % gist_id)
+                if sanitize_rendered(rendered, whitelist):
+                    to_put.append(rendered)
+                contents[gist_id] = rendered.sanitized
+        else:
+            to_fetch[gist_id] = rendered
+
+    # queue the refreshes in one go.  readers still get the stale copies if the queue is having trouble
+    if to_refresh:
         try:
-            # go fetch the gist using the gist_id
-            http = httplib2.Http(cache=None, timeout=10, proxy_info=None)
-            headers, content = http.request('https://api.github.com/gists/%s?client_id=%s&client_secret=%s' % (gist_id, config.github_client_id, config.github_client_secret), method='GET', body=None, headers=None)
-            
-            if headers['status'] == '404':
-                logging.info("looked for gist ID %s but didn't find it.  404 bitches.")
-                return False
-
-            # strip bad UTF-8 stuff if it exists (like in a gist with a .png)
-            content = content.decode('utf-8', 'replace')
-            gist = simplejson.loads(content)
-
-
-            # see if we have .md or .rst file matching our filenames in config
-            if config.gist_markdown_name in gist['files']:
-                gist_content_url = gist['files'][config.gist_markdown_name]['raw_url']
-                headers, content = http.request(gist_content_url, method='GET', headers=None)
-                gist_html = markdown.markdown(content)
-            elif config.gist_restructuredtext_name in gist['files']:
-                gist_content_url = gist['files'][config.gist_restructuredtext_name]['raw_url']
-                headers, content = http.request(gist_content_url, method='GET', headers=None)
-                parts = publish_parts(source=content, writer_name='html4css1', settings_overrides={'title': '', 'report_level': 'quiet', '_disable_config': True})
-                gist_html = parts['html_body'].replace('class="docinfo"', 'class="table table-striped"').replace('class="docutils', 'class="table table-striped table-bordered')
-            else:
-                logging.info("not finding a valid markdown file to display for content")
-                return False
-            
-            if not memcache.add('%s:content' % gist_id, gist_html, config.memcache_expire_time):
-                logging.info("memcache add of content from gist %s failed." % gist_id)
+            queue_gist_refreshes(to_refresh)
+        except taskqueue.Error:
+            logging.exception("couldn't queue refreshes for %s." % ", ".join(rendered.key.id() for rendered in to_refresh))
+
+    # only one request at a time goes to github for a gist, the rest serve what we have or wait on it
+    leased = lease_gists(to_fetch.keys())
+    for gist_id in [gist_id for gist_id in to_fetch if gist_id not in leased]:
+        rendered = to_fetch[gist_id]
+        if rendered:
+            logging.info("serving old render of gist %s while another request refreshes it." % gist_id)
+            if sanitize_rendered(rendered, whitelist):
+                to_put.append(rendered)
+            contents[gist_id] = rendered.sanitized
+            del to_fetch[gist_id]
+
+    # nobody is getting anything out of github while the circuit is open, so don't wait on them
+    waiting = [gist_id for gist_id in to_fetch if gist_id not in leased]
+    if waiting and not circuit.is_open():
+        for gist_id, html in wait_for_gist_contents(waiting, whitelist).items():
+            contents[gist_id] = html
+            del to_fetch[gist_id]
 
-            return gist_html
+    try:
+        # go fetch all the gists we still need at the same time
+        if to_fetch:
+            try:
+                current, failures = yield fetch_gists_async(to_fetch, whitelist)
+            except Exception:
+                logging.exception("fetching %s from github blew up." % ", ".join(to_fetch))
+                current, failures = [], dict((gist_id, GIST_UPSTREAM_ERROR) for gist_id in to_fetch)
+            for rendered in current:
+                to_put.append(rendered)
+                contents[rendered.key.id()] = rendered.sanitized
+                to_cache[rendered.key.id()] = (rendered.sanitized, config.memcache_expire_time)
+
+            # github let us down, but an old render beats no render at all
+            for gist_id, rendered in to_fetch.items():
+                if rendered and not contents[gist_id] and failures.get(gist_id, GIST_UPSTREAM_ERROR) == GIST_UPSTREAM_ERROR:
+                    logging.info("serving old render of gist %s while github is having trouble." % gist_id)
+                    failures.pop(gist_id, None)
+                    if sanitize_rendered(rendered, whitelist):
+                        to_put.append(rendered)
+                    contents[gist_id] = rendered.sanitized
+
+            cache_gist_failures(failures)
+
+        if to_put:
+            try:
+                ndb.put_multi(to_put)
+            except:
+                # readers have their html already, the stored copies can catch up another time
+                logging.exception("couldn't store the renders of %s." % ", ".join(rendered.key.id() for rendered in to_put))
+
+        if to_cache:
+            failed = cache_gist_contents(to_cache, whitelist)
+            if failed:
+                logging.info("memcache add of content failed for %s." % ", ".join(failed))
+
+    finally:
+        if leased:
+            memcache.delete_multi(leased, key_prefix='gist-lease:')
+
+    raise ndb.Return(contents)
+
+
+# put {gist_id: (html, seconds)} into memcache, returning the keys that didn't go in.  add leaves
+# alone anything another request cached first
+def cache_gist_contents(to_cache, whitelist, add=True):
+    by_time = {}
+    for gist_id, (html, seconds) in to_cache.items():
+        by_time.setdefault(seconds, {})[content_key(gist_id, whitelist)] = html
+    failed = []
+    for seconds, htmls in by_time.items():
+        if add:
+            failed.extend(memcache.add_multi(htmls, seconds))
+        else:
+            failed.extend(memcache.set_multi(htmls, seconds))
+    return failed
+
+
+# take a short lease on rendering each gist, returning the ones we got
+def lease_gists(gist_ids):
+    if not gist_ids:
+        return []
+    failed = memcache.add_multi(dict((gist_id, True) for gist_id in gist_ids), config.gist_fetch_deadline * 2, key_prefix='gist-lease:')
+    return [gist_id for gist_id in gist_ids if gist_id not in failed]
+
+
+# poll memcache for gists someone else holds the lease on, for up to config.gist_lease_wait
+# returns {gist_id: html} for the ones that showed up, the caller is on its own for the rest
+def wait_for_gist_contents(gist_ids, whitelist):
+    contents = {}
+    end_time = time.time() + config.gist_lease_wait
+    while len(contents) < len(gist_ids) and time.time() < end_time:
+        time.sleep(0.2)
+        cached = memcache.get_multi([content_key(gist_id, whitelist) for gist_id in gist_ids if gist_id not in contents])
+        for gist_id in gist_ids:
+            if content_key(gist_id, whitelist) in cached:
+                contents[gist_id] = cached[content_key(gist_id, whitelist)]
+
+    if len(contents) < len(gist_ids):
+        logging.info("gave up waiting on other requests to render some of %s." % ", ".join(gist_ids))
+    return contents
+
+
+# bring a gist's stored render up to date with github, replacing whatever memcache has.  returns False
+# if it was put off or the gist can't be rendered, and raises GistFetchError when github let us down
+def refresh_gist_content(gist_id):
+    # leave the last of the rate limit to readers, and try again once github resets it
+    if not ratelimit.has_spare():
+        logging.info("holding off on refreshing gist %s until the rate limit resets." % gist_id)
+        queue_gist_refresh(gist_id)
+        return False
 
+    if circuit.is_open():
+        logging.info("holding off on refreshing gist %s while github is down." % gist_id)
+        queue_gist_refresh(gist_id, countdown=config.github_circuit_cooldown)
+        return False
+
+    whitelist = get_whitelist_hash()
+    rendered = models.RenderedArticle.get_by_id(gist_id)
+
+    current, failures = fetch_gists({gist_id: rendered}, whitelist)
+    if not current:
+        cache_gist_failures(failures, {gist_id: rendered})
+        if failures.get(gist_id, GIST_UPSTREAM_ERROR) == GIST_UPSTREAM_ERROR:
+            raise GistFetchError("couldn't refresh gist %s from github." % gist_id)
+        return False
+
+    current[0].put()
+    memcache.set(content_key(gist_id, whitelist), current[0].sanitized, config.memcache_expire_time)
+    return True
+
+
+# get gists rendered and into memcache before a reader asks for them.  fresh stored renders just go
+# back into memcache, and gists that are missing, stale or going stale in the next lead seconds are
+# revalidated or rendered with github in one go, as long as the rate limit has spare and github is up.
+# returns (cached, refreshed, held) - the gist_ids put back in memcache from the datastore, brought up
+# to date with github and left for later
+def warm_gist_contents(gist_ids, lead=0):
+    gist_ids = list(set(gist_ids))
+    whitelist = get_whitelist_hash()
+
+    # gists that recently failed to render are left alone until their negative cache entry runs out
+    keys = [content_key(gist_id, whitelist) for gist_id in gist_ids] + [missing_key(gist_id) for gist_id in gist_ids]
+    cached = memcache.get_multi(keys)
+    gist_ids = [gist_id for gist_id in gist_ids if missing_key(gist_id) not in cached]
+    stored = ndb.get_multi([ndb.Key(models.RenderedArticle, gist_id) for gist_id in gist_ids])
+
+    to_cache = {}
+    to_put = []
+    to_fetch = {}
+    for gist_id, rendered in zip(gist_ids, stored):
+        if not rendered or not rendered.is_fresh(lead):
+            to_fetch[gist_id] = rendered
+        elif content_key(gist_id, whitelist) not in cached:
+            if sanitize_rendered(rendered, whitelist):
+                to_put.append(rendered)
+            to_cache[gist_id] = (rendered.sanitized, rendered.get_cache_time())
+
+    refreshed = []
+    held = []
+    if to_fetch and (not ratelimit.has_spare() or circuit.is_open()):
+        logging.info("holding off on warming %s until github can spare the calls." % ", ".join(to_fetch))
+        held = to_fetch.keys()
+    elif to_fetch:
+        current, failures = fetch_gists(to_fetch, whitelist)
+        for rendered in current:
+            to_put.append(rendered)
+            to_cache[rendered.key.id()] = (rendered.sanitized, config.memcache_expire_time)
+            refreshed.append(rendered.key.id())
+
+        cache_gist_failures(failures, to_fetch)
+
+    if to_put:
+        ndb.put_multi(to_put)
+
+    if to_cache:
+        cache_gist_contents(to_cache, whitelist, add=False)
+
+    return [gist_id for gist_id in to_cache if gist_id not in refreshed], refreshed, held
+
+
+# revalidate or render each of {gist_id: stored render or None} against github in parallel
+# stale copies are revalidated with their etag, and a 304 just extends their life without a render
+# returns the RenderedArticles that are now current, sanitized but not yet put, and {gist_id: reason}
+# for the ones that couldn't be rendered
+def fetch_gists(to_fetch, whitelist):
+    return fetch_gists_async(to_fetch, whitelist).get_result()
+
+
+@ndb.tasklet
+def fetch_gists_async(to_fetch, whitelist):
+    current = []
+    failures = {}
+    end_time = time.time() + config.gist_fetch_deadline
+    try:
+        rpcs = client.request_async(
+            dict((gist_id, gist_url(gist_id)) for gist_id in to_fetch),
+            deadline=config.gist_fetch_deadline,
+            headers=dict((gist_id, revalidation_headers(rendered)) for gist_id, rendered in to_fetch.items())
+        )
+    except circuit.CircuitOpenError:
+        # github is down, which says nothing about the gists themselves, so nothing gets negatively cached
+        logging.info("github circuit is open, not fetching %s." % ", ".join(to_fetch))
+        raise ndb.Return(current, failures)
+
+    files = {}
+    to_render = {}
+    for gist_id, rpc in rpcs.items():
+        rendered = to_fetch[gist_id]
+        try:
+            result = yield client.get_result_async(rpc)
+            if result.status_code == 404:
+                logging.info("looked for gist ID %s but didn't find it.  404 bitches." % gist_id)
+                failures[gist_id] = GIST_NOT_FOUND
+                continue
+
+            if result.status_code == 304 and rendered:
+                # github says nothing changed, so all we do is extend the life of the stored copy
+                logging.info("gist %s not modified since we rendered it." % gist_id)
+            else:
+                # strip bad UTF-8 stuff if it exists (like in a gist with a .png)
+                gist = simplejson.loads(result.content.decode('utf-8', 'replace'))
+                revision = get_gist_revision(gist)
+                etag = result.headers.get('ETag')
+                last_modified = result.headers.get('Last-Modified')
+
+                if not (rendered and revision and rendered.revision == revision):
+                    filename, gist_file = get_gist_file(gist)
+                    if not filename:
+                        logging.info("not finding a valid markdown file to display for content")
+                        failures[gist_id] = GIST_NO_CONTENT
+                        continue
+
+                    rendered = models.RenderedArticle(id=gist_id, revision=revision, etag=etag, last_modified=last_modified)
+                    if is_truncated(gist_file):
+                        files[gist_id] = (filename, gist_file['raw_url'], rendered)
+                    else:
+                        to_render[gist_id] = (filename, gist_file['content'], rendered)
+                    continue
+
+                # nothing changed on github since we rendered it, so just freshen the stored copy
+                logging.info("stored render of gist %s is still current." % gist_id)
+                rendered.etag = etag
+                rendered.last_modified = last_modified
+
+            rendered.mark_rendered()
+            sanitize_rendered(rendered, whitelist)
+            current.append(rendered)
+
+        except Exception:
+            logging.info("got an exception while talking to github about gist %s" % gist_id)
+            failures[gist_id] = GIST_UPSTREAM_ERROR
+
+    # second round for the raw files of truncated gists, with whatever is left of the deadline
+    remaining = end_time - time.time()
+    if files and remaining > 0:
+        try:
+            rpcs = client.request_async(dict((gist_id, raw_url) for gist_id, (filename, raw_url, rendered) in files.items()), deadline=remaining)
+        except circuit.CircuitOpenError:
+            logging.info("github circuit opened, not fetching raw files for %s." % ", ".join(files))
+            rpcs = {}
+
+        for gist_id, rpc in rpcs.items():
+            filename, raw_url, rendered = files[gist_id]
+            try:
+                result = yield client.get_result_async(rpc)
+                to_render[gist_id] = (filename, result.content, rendered)
+            except Exception:
+                logging.info("got an exception while fetching the file for gist %s" % gist_id)
+                failures[gist_id] = GIST_UPSTREAM_ERROR
+    elif files:
+        logging.info("ran out of time fetching raw files for %s" % ", ".join(files))
+        failures.update((gist_id, GIST_UPSTREAM_ERROR) for gist_id in files)
+
+    for gist_id, (filename, content, rendered) in to_render.items():
+        try:
+            rendered.html = render_gist_file(filename, content)
+            rendered.mark_rendered()
+            sanitize_rendered(rendered, whitelist)
+            current.append(rendered)
         except:
-            logging.info("got an exception while talking to github")
-            return False
+            logging.info("got an exception while rendering gist %s" % gist_id)
+            failures[gist_id] = GIST_RENDER_ERROR
+
+    raise ndb.Return(current, failures)
+
 
 def fork_gist(access_token, gist_id):
     try:
         params = {'access_token': access_token}
         uri = 'https://api.github.com/gists/%s/fork?%s' % (gist_id, urllib.urlencode(params))
-        http = httplib2.Http(cache=None, timeout=None, proxy_info=None)
-        headers, content = http.request(uri, method='POST', headers=None)
+        content = None
+        response = client.request(uri, method='POST', deadline=client.WRITE_DEADLINE)
+        content = response.content
         gist = simplejson.loads(content)
 
         try:
-            # grab the raw file and parse it for yaml bits
-            if gist['files'][config.gist_manifest_name]['raw_url']:
-                headers, content = http.request(gist['files'][config.gist_manifest_name]['raw_url'])
-                manifest = yaml.load(content)
+            # grab the manifest file and parse it for yaml bits
+            manifest = yaml.load(get_gist_file_content(gist['files'][config.gist_manifest_name]))
         
             gist_meta = {
                 'title': manifest['title'], 
@@ -204,7 +707,15 @@ def fork_gist(access_token, gist_id):
 
 
 def flush_gist_content(gist_id):
-    if memcache.delete('%s:content' % gist_id):
+    # the stored render stays around to serve while a task checks it against github
+    rendered = models.RenderedArticle.mark_stale(gist_id)
+    if rendered:
+        queue_gist_refresh(gist_id, rendered)
+
+    # give a gist that was broken another chance
+    memcache.delete(missing_key(gist_id))
+
+    if memcache.delete(content_key(gist_id, get_whitelist_hash())):
         logging.info("flushed cache!")
         return True
     else:
@@ -212,17 +723,30 @@ def flush_gist_content(gist_id):
         return False
 
 
+# bring a gist we know just changed up to date in the cache now, rather than leaving it to a reader
+def prerender_gist_content(gist_id):
+    memcache.delete(missing_key(gist_id))
+    try:
+        if refresh_gist_content(gist_id):
+            return True
+    except GistFetchError, e:
+        logging.info(e)
+
+    # couldn't get it done now, so don't leave the old render in front of readers
+    flush_gist_content(gist_id)
+    return False
+
+
 def put_user_gist(access_token, body):
     try:
         # stuff that sucker to github
         params = {'access_token': access_token}
         base_uri = 'https://api.github.com/gists'
         uri = '%s?%s' % (base_uri, urllib.urlencode(params))
-        http = httplib2.Http(cache=None, timeout=None, proxy_info=None)
-        headers, content = http.request(uri, method='POST', body=body, headers=None)
+        response = client.request(uri, method='POST', body=body, deadline=client.WRITE_DEADLINE)
 
         # check github said it made it ok
-        return simplejson.loads(content)
+        return simplejson.loads(response.content)
     except:
         return False
 
@@ -233,7 +757,6 @@ def delete_user_gist(access_token, gist_id):
         params = {'access_token': access_token}
         base_uri = 'https://api.github.com/gists/%s' % gist_id
         uri = '%s?%s' % (base_uri, urllib.urlencode(params))
-        http = httplib2.Http(cache=None, timeout=None, proxy_info=None)
-        headers, content = http.request(uri, method='DELETE', headers=None)        
+        client.request(uri, method='DELETE', deadline=client.WRITE_DEADLINE)
     except:
         return False
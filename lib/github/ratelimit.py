@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+##
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Github rate limit budget tracking.
+
+Every github response tells us how many calls the credential that made it has
+left and when that resets.  We keep the latest numbers in memcache for each
+credential, so background work can back off and leave a reserve of calls
+(config.github_rate_limit_reserve) for readers who hit a cache miss.
+"""
+
+import time, hashlib, urlparse
+import config
+from google.appengine.api import memcache
+
+# calls made with the app's client_id/secret rather than a user's token
+APP = 'app'
+ANONYMOUS = 'anonymous'
+
+
+def credential_for_token(access_token):
+    # don't keep tokens lying around in memcache keys
+    return 'token:%s' % hashlib.md5(access_token).hexdigest()[:12]
+
+
+def credential_for_uri(uri):
+    query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+    if 'access_token' in query:
+        return credential_for_token(query['access_token'][0])
+    elif 'client_id' in query:
+        return APP
+    else:
+        return ANONYMOUS
+
+
+def budget_key(credential):
+    return 'github-ratelimit:%s' % credential
+
+
+# remember the rate limit headers github sent back for a call to uri
+def record(uri, headers):
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is None:
+        return
+
+    budget = {
+        'limit': int(headers.get('X-RateLimit-Limit', 0)),
+        'remaining': int(remaining),
+        'reset': int(headers.get('X-RateLimit-Reset', 0)),
+        'recorded': int(time.time()),
+    }
+    # reset is a unix timestamp, which memcache takes as an absolute expiry
+    memcache.set(budget_key(credential_for_uri(uri)), budget, budget['reset'])
+
+
+# the last budget we saw for a credential, or None if we haven't seen one since it reset
+def get_budget(credential=APP):
+    return memcache.get(budget_key(credential))
+
+
+# is there budget left over after the reserve we keep for readers?
+def has_spare(credential=APP):
+    budget = get_budget(credential)
+    return not budget or budget['remaining'] > config.github_rate_limit_reserve
+
+
+# how long background work should hold off, in seconds.  the spare budget gets spread over the
+# time left until github resets it, so the less there is the slower we go, and once only the
+# reserve is left we wait for the reset
+def get_background_delay(credential=APP):
+    budget = get_budget(credential)
+    if not budget:
+        return 0
+
+    until_reset = max(0, budget['reset'] - int(time.time()))
+    spare = budget['remaining'] - config.github_rate_limit_reserve
+    if spare <= 0:
+        return until_reset
+    return until_reset / spare
@@ -56,6 +56,9 @@ _routes = [
     RedirectRoute('/change-email/<user_id>/<encoded_email>/<token>/', userhandlers.EmailChangedCompleteHandler, name='email-changed-check', strict_slash=True),
     RedirectRoute('/secure/', userhandlers.SecureRequestHandler, name='secure', strict_slash=True),
 
+    # user lookups
+    RedirectRoute('/users/buildlookups/', userhandlers.BuildLookupsHandler, name='users-build-lookups', strict_slash=True),
+
     # website pages
     RedirectRoute('/', handlers.HomeRequestHandler, name='home', strict_slash=True),
     RedirectRoute('/forums/', handlers.ForumsHandler, name='forums', strict_slash=True),
@@ -69,6 +72,10 @@ _routes = [
     RedirectRoute('/blog/feed/rss/', bloghandlers.PublicBlogRSSHandler, name='blog-rss', strict_slash=True),
     RedirectRoute('/blog/refresh/', bloghandlers.BlogRefreshHandler, name='blog-refresh', strict_slash=True),
     RedirectRoute('/blog/buildlist/', bloghandlers.BlogBuildListHandler, name='blog-build', strict_slash=True),
+    RedirectRoute('/blog/syncgist/', bloghandlers.BlogSyncGistHandler, name='blog-sync-gist', strict_slash=True),
+    RedirectRoute('/blog/refreshgist/', bloghandlers.BlogRefreshGistHandler, name='blog-refresh-gist', strict_slash=True),
+    RedirectRoute('/blog/warmcache/', bloghandlers.BlogWarmCacheHandler, name='blog-warm-cache', strict_slash=True),
+    RedirectRoute('/blog/backfillowners/', bloghandlers.BlogBackfillOwnersHandler, name='blog-backfill-owners', strict_slash=True),
     RedirectRoute('/blog/menu/<menu_id>', bloghandlers.BlogUserMenuHandler, name='blog-menu', strict_slash=True), # see class for fix info
     RedirectRoute('/blog/<username>/new/', bloghandlers.BlogArticleCreateHandler, name='blog-article-create', strict_slash=True),
     RedirectRoute('/blog/<username>/articles/', bloghandlers.BlogArticleListHandler, name='blog-article-list', strict_slash=True),
@@ -81,6 +88,9 @@ _routes = [
     # throwback URLs for old stackgeek.com site - do not include in gae-boilerplate changes
     RedirectRoute('/guides/<slug>', bloghandlers.BlogArticleSlugHandler, name='guides-article', strict_slash=True),
 
+    # monitoring
+    RedirectRoute('/github/ratelimit/', handlers.GithubRateLimitHandler, name='github-ratelimit', strict_slash=True),
+
     # channel watcher
     RedirectRoute('/_ah/channel/connected/', handlers.channelHandler, name='channel-connected', strict_slash=True),
     RedirectRoute('/_ah/channel/disconnected/', handlers.channelHandler, name='channel-disconnected', strict_slash=True),
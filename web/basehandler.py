@@ -6,6 +6,7 @@ import re
 # related third party imports
 import webapp2
 from google.appengine.api.users import NotAllowedError
+from google.appengine.ext import ndb
 from webapp2_extras import jinja2
 from webapp2_extras import auth
 from webapp2_extras import sessions
@@ -43,6 +44,15 @@ def user_required(handler):
 
     return check_login
 
+def gather(**futures):
+    """
+         Waits on the ndb futures a handler's page needs and returns
+         their results by name.  Start everything before calling this
+         so the lookups run side by side instead of one after another.
+    """
+    ndb.Future.wait_all(futures.values())
+    return dict((name, future.get_result()) for name, future in futures.items())
+
 def generate_csrf_token():
     session = sessions.get_store().get_session()
     if '_csrf_token' not in session:
@@ -173,18 +183,23 @@ class BaseHandler(webapp2.RequestHandler):
         return str(self.user['user_id']) if self.user else None
 
     @webapp2.cached_property
-    def user_key(self):
+    def user_info(self):
+        # the logged in user's entity, loaded once for the whole request
         if self.user:
-            user_info = models.User.get_by_id(long(self.user_id))
-            return user_info.key
+            return models.User.get_by_id(long(self.user_id))
+        return None
+
+    @webapp2.cached_property
+    def user_key(self):
+        if self.user_info:
+            return self.user_info.key
         return  None
 
     @webapp2.cached_property
     def username(self):
         if self.user:
             try:
-                user_info = models.User.get_by_id(long(self.user_id))
-                return str(user_info.username)
+                return str(self.user_info.username)
             except AttributeError, e:
                 # avoid AttributeError when the session was delete from the server
                 logging.error(e)
@@ -196,8 +211,7 @@ class BaseHandler(webapp2.RequestHandler):
     def is_admin(self):
         if self.user:
             try:
-                user_info = models.User.get_by_id(long(self.user_id))
-                if user_info.username == config.admin_username:
+                if self.user_info.username == config.admin_username:
                     return True
                 else:
                     return False
@@ -209,8 +223,7 @@ class BaseHandler(webapp2.RequestHandler):
     def email(self):
         if self.user:
             try:
-                user_info = models.User.get_by_id(long(self.user_id))
-                return user_info.email
+                return self.user_info.email
             except AttributeError, e:
                 # avoid AttributeError when the session was delete from the server
                 logging.error(e)
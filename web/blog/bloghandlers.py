@@ -7,7 +7,7 @@ Blog Handlers
 import logging, os
 import urllib, urllib2, hashlib, httplib2
 import json
-import datetime
+import datetime, time, calendar
 import re
 
 # related third party imports
@@ -18,11 +18,13 @@ from webapp2_extras.i18n import gettext as _
 from webapp2_extras.appengine.auth.models import Unique
 from web.basehandler import BaseHandler
 from web.basehandler import user_required
+from web.basehandler import gather
 
 # google shizzle
 from google.appengine.api import taskqueue
 from google.appengine.api import channel
 from google.appengine.ext import db
+from google.appengine.ext import ndb
 
 # local application/library specific imports
 import config
@@ -35,6 +37,7 @@ import html5lib
 
 # social login
 from lib.github import github
+from lib.github import ratelimit
 from lib.twitter import twitter
 
 
@@ -46,46 +49,45 @@ class PublicBlogHandler(BaseHandler):
     def get(self):
         # load articles in from db and github, stuff them in an array
         date_format = "%a, %d %b %Y"
-        articles = models.Article.get_all()
+        cursor = self.request.get('cursor')
+        articles, next_cursor = models.Article.get_published_page('post', cursor)
+        models.Article.fill_owners(articles)
         blogposts = []
+
+        # fetch content for all the articles from Github in one go
+        gist_contents = github.get_gist_contents([article.gist_id for article in articles])
         
         # loop through all articles
         for article in articles:
             # if there's content on Github to serve
-            try:
-                gist_content = github.get_gist_content(article.gist_id)
-            except:
-                continue
+            gist_content = gist_contents.get(article.gist_id)
 
             if gist_content:
-                # sanitize javascript
-                article_html = bleach.clean(gist_content, config.bleach_tags, config.bleach_attributes)
+                # content comes back from github already sanitized
+                article_html = gist_content
                 article_title = bleach.clean(article.title)
                 article_summary = bleach.clean(article.summary)
 
                 # created and by whom
                 created = article.created.strftime(date_format)
-                owner_info = models.User.get_by_id(article.owner.id())
                 
                 # build entry
                 entry = {
                     'created': created,
                     'article_id': article.key.id(),
                     'article_title': article_title,
-                    'article_type': article.article_type, 
+                    'article_type': 'post',
                     'article_html': article_html,
                     'article_summary': article_summary,
                     'article_slug': article.slug,
-                    'article_owner': owner_info.username,
+                    'article_owner': article.owner_username,
                     'article_host': self.request.host,
                 }
-                
-                # append article if it's a guide, it's public, and not a draft            
-                if article.article_type == 'post' and article.public and not article.draft:
-                    blogposts.append(entry)
+
+                blogposts.append(entry)
         
         # pack and stuff into template
-        params = {'blogposts': blogposts}
+        params = {'blogposts': blogposts, 'cursor': cursor, 'next_cursor': next_cursor}
         return self.render_template('blog/blog.html', **params)
 
 
@@ -93,89 +95,68 @@ class PublicGuideHandler(BaseHandler):
     def get(self):
         # load articles in from db and github, stuff them in an array
         date_format = "%a, %d %b %Y"
-        articles = models.Article.get_all()
+        cursor = self.request.get('cursor')
+        articles, next_cursor = models.Article.get_published_page('guide', cursor)
+        models.Article.fill_owners(articles)
         guides = []
+
+        # fetch content for all the articles from Github in one go
+        gist_contents = github.get_gist_contents([article.gist_id for article in articles])
         
         # loop through all articles
         for article in articles:
             # if there's content on Github to serve
-            gist_content = github.get_gist_content(article.gist_id)
+            gist_content = gist_contents.get(article.gist_id)
 
             if gist_content:
-                # sanitize javascript
-                article_html = bleach.clean(gist_content, config.bleach_tags, config.bleach_attributes)
+                # content comes back from github already sanitized
+                article_html = gist_content
                 article_title = bleach.clean(article.title)
                 article_summary = bleach.clean(article.summary)
 
                 # created and by whom
                 created = article.created.strftime(date_format)
-                owner_info = models.User.get_by_id(article.owner.id())
 
                 # build entry
                 entry = {
                     'created': created,
                     'article_id': article.key.id(),
                     'article_title': article_title,
-                    'article_type': article.article_type, 
+                    'article_type': 'guide',
                     'article_html': article_html,
                     'article_summary': article_summary,
                     'article_slug': article.slug,
-                    'article_owner': owner_info.username,
+                    'article_owner': article.owner_username,
                     'article_host': self.request.host,
                 }
-                
-                # append article if we have content, it's a guide, it's public, and not a draft
-                if article.article_type == 'guide' and article.public and not article.draft:
-                    guides.append(entry)
+
+                guides.append(entry)
 
         # pack and stuff into template
-        params = {'guides': guides}
+        params = {'guides': guides, 'cursor': cursor, 'next_cursor': next_cursor}
         return self.render_template('blog/guide.html', **params)
 
 
-# TODO: needs to be fixed to guarantee 10 items get spit out
 class PublicBlogRSSHandler(BaseHandler):
-   def get(self):
+    def get(self):
         # load articles in from db and github, stuff them in an array
-        date_format = "%a, %d %b %Y"
-
         blog_title = "The %s Blog" % config.app_name
         epoch_start = datetime.datetime(1970, 1, 1)
         blog_last_updated = epoch_start
 
+        # keep paging through our articles until we have a full feed, skipping the ones
+        # github doesn't have content for
         entries = []
-        
-        # fetch our articles
-        articles = models.Article.get_all()
-        
-        for article in articles[0:10]:
-            gist_content = github.get_gist_content(article.gist_id)
+        cursor = None
+        for page in range(config.blog_feed_max_pages):
+            articles, cursor = models.Article.get_feed_page(cursor)
+            entries.extend(self.build_entries(articles)[0:config.blog_page_size - len(entries)])
+            if len(entries) >= config.blog_page_size or not cursor:
+                break
 
-            if gist_content:
-                # sanitize
-                article_html = bleach.clean(gist_content, config.bleach_tags, config.bleach_attributes)
-                article_title = bleach.clean(article.title)
-                article_summary = bleach.clean(article.summary)
-
-                # look up owner
-                owner_info = models.User.get_by_id(article.owner.id())
-
-                if article.updated > blog_last_updated:
-                    blog_last_updated = article.updated
-                entry = {
-                    'slug': article.slug,
-                    'article_type': article.article_type,
-                    'created': article.created,
-                    'author_email': owner_info.email,
-                    'author_username': owner_info.username,
-                    'updated': article.updated,
-                    'title': article_title, 
-                    'summary': article_summary, 
-                    'html': article_html,
-                }
-
-                if not article.draft:
-                    entries.append(entry)
+        for entry in entries:
+            if entry['updated'] > blog_last_updated:
+                blog_last_updated = entry['updated']
 
         # didn't get any matches in our loop
         date_format = "%a, %d %b %Y %H:%M:%S GMT"
@@ -194,33 +175,55 @@ class PublicBlogRSSHandler(BaseHandler):
         self.response.headers['Content-Type'] = 'application/xml'
         return self.render_template('blog/feed.xml', **params)
 
+    def build_entries(self, articles):
+        models.Article.fill_owners(articles)
+        gist_contents = github.get_gist_contents([article.gist_id for article in articles])
+
+        entries = []
+        for article in articles:
+            gist_content = gist_contents.get(article.gist_id)
+
+            if gist_content:
+                # content comes back from github already sanitized
+                entry = {
+                    'slug': article.slug,
+                    'article_type': article.article_type,
+                    'created': article.created,
+                    'author_email': article.owner_email,
+                    'author_username': article.owner_username,
+                    'updated': article.updated,
+                    'title': bleach.clean(article.title),
+                    'summary': bleach.clean(article.summary),
+                    'html': gist_content,
+                }
+                entries.append(entry)
+        return entries
+
 
 class BlogArticleSlugHandler(BaseHandler):
     # default to admin if you can't find article
     def get(self, username=config.admin_username, article_type='guides', slug = None):
 
-        # look up our owner
-        user = models.User.get_by_username(username)
-
-        # look up the article
-        try:
-            article = models.Article.get_by_user_and_slug(user.key, slug)
-            if not article:
-                return self.render_template('errors/default_error.html')
-        except:
+        # look up the article, it has what we need to know about its owner
+        article = models.Article.get_by_username_and_slug(username, slug)
+        if not article:
             return self.render_template('errors/default_error.html')
             
-        gist_content = github.get_gist_content(article.gist_id)
+        # get the owner's twitter details on the way while github gets the content
+        twitter_user = models.SocialUser.get_by_user_and_provider_async(article.owner, 'twitter')
+        owner_info = article.owner.get_async()
+        gist_content = github.get_gist_content_async(article.gist_id)
+        data = gather(twitter_user=twitter_user, owner_info=owner_info, gist_content=gist_content)
+        gist_content = data['gist_content']
+        models.Article.fill_owners([article])
 
         # if there's content on Github to serve
         if gist_content:
-            twitter_user = models.SocialUser.get_by_user_and_provider(user.key, 'twitter')
-            owner_info = models.User.get_by_id(article.owner.id())
             
             # twitter widget stuff
-            if twitter_user:
-                twitter_username = twitter_user.screen_name
-                twitter_widget_id = owner_info.twitter_widget_id
+            if data['twitter_user']:
+                twitter_username = data['twitter_user'].screen_name
+                twitter_widget_id = data['owner_info'].twitter_widget_id
             else:
                 twitter_username = config.app_twitter_username
                 twitter_widget_id = config.app_twitter_widget_id
@@ -232,10 +235,7 @@ class BlogArticleSlugHandler(BaseHandler):
                 menu_choice = 'blog'
 
             # load name
-            if not owner_info.name:
-                name = owner_info.username
-            else:
-                name = "%s %s" % (owner_info.name, owner_info.last_name)
+            name = article.owner_name
 
             # load github use
             try:
@@ -246,8 +246,8 @@ class BlogArticleSlugHandler(BaseHandler):
             # load articles in from db and github, stuff them in an array
             date_format = "%a, %d %b %Y"
 
-            # sanitize javascript
-            article_html = bleach.clean(gist_content, config.bleach_tags, config.bleach_attributes)
+            # content comes back from github already sanitized
+            article_html = gist_content
             article_title = bleach.clean(article.title)
             article_summary = bleach.clean(article.summary)
 
@@ -260,7 +260,7 @@ class BlogArticleSlugHandler(BaseHandler):
                 'article_html': article_html, 
                 'article_slug': article.slug,
                 'article_type': article.article_type,
-                'article_owner': owner_info.username,
+                'article_owner': article.owner_username,
                 'article_host': self.request.host,
                 #'twitter_username': twitter_username,
             }
@@ -290,15 +290,33 @@ class BlogUserHandler(BaseHandler):
             params = {}
             return self.redirect_to('home', **params)
 
+        # start on the user's social accounts and a page of their articles, all at once
+        cursor = self.request.get('cursor')
+        article_page = models.Article.get_user_page_async(owner_info.key, cursor)
+        owner_social_user = models.SocialUser.get_by_user_and_provider_async(owner_info.key, 'github')
+        twitter_user = models.SocialUser.get_by_user_and_provider_async(owner_info.key, 'twitter')
+
         # load name
         if not owner_info.name:
             name = bleach.clean(owner_info.username)
         else:
             name = "%s %s" % (bleach.clean(owner_info.name), bleach.clean(owner_info.last_name))
 
+        # load articles in from db and github, stuff them in seperate arrays.  the social
+        # accounts can keep loading while github works
+        date_format = "%a, %d %b %Y"
+        articles, next_cursor = article_page.get_result()
+        blogposts = []
+        guides = []
+
+        # fetch content for all the articles from Github in one go, alongside the social accounts
+        gist_contents = github.get_gist_contents_async([article.gist_id for article in articles])
+
         # find the browsed user's github username (used for follow button)
-        owner_social_user = models.SocialUser.get_by_user_and_provider(owner_info.key, 'github')
-        twitter_user = models.SocialUser.get_by_user_and_provider(owner_info.key, 'twitter')
+        data = gather(owner_social_user=owner_social_user, twitter_user=twitter_user, gist_contents=gist_contents)
+        owner_social_user = data['owner_social_user']
+        twitter_user = data['twitter_user']
+        gist_contents = data['gist_contents']
 
         # load github usernames
         try:
@@ -320,20 +338,14 @@ class BlogUserHandler(BaseHandler):
         else:
             gravatar_url = owner_info.gravatar_url
 
-        # load articles in from db and github, stuff them in seperate arrays
-        date_format = "%a, %d %b %Y"
-        articles = models.Article.get_by_user(owner_info.key)
-        blogposts = []
-        guides = []
-        
         # loop through all articles and build a list of both posts and articles
         for article in articles:
             # if there's content on Github to serve
-            gist_content = github.get_gist_content(article.gist_id)
+            gist_content = gist_contents.get(article.gist_id)
             
             if gist_content:
-                # sanitize javascript            
-                article_html = bleach.clean(gist_content, config.bleach_tags, config.bleach_attributes)
+                # content comes back from github already sanitized
+                article_html = gist_content
                 article_title = bleach.clean(article.title)
                 article_summary = bleach.clean(article.summary)
 
@@ -352,11 +364,10 @@ class BlogUserHandler(BaseHandler):
                 
                 # we switch between adding to the two lists here
                 # will need video handling eventually
-                if gist_content and not article.draft:
-                    if article.article_type == 'post':
-                        blogposts.append(entry)
-                    else:
-                        guides.append(entry)
+                if article.article_type == 'post':
+                    blogposts.append(entry)
+                else:
+                    guides.append(entry)
 
         # add extra single entry items, and then add the posts and guides seperately
         params = {
@@ -370,6 +381,8 @@ class BlogUserHandler(BaseHandler):
             'twitter_widget_id': owner_info.twitter_widget_id, 
             'blogposts': blogposts, 
             'guides': guides,
+            'cursor': cursor,
+            'next_cursor': next_cursor,
         }
         return self.render_template('blog/blog_user.html', **params)
 
@@ -386,7 +399,7 @@ class BlogArticleActionsHandler(BaseHandler):
             return
 
         # pull the github token out of the social user db and then fork it
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
         article = models.Article.get_by_id(long(article_id))
 
@@ -404,10 +417,10 @@ class BlogArticleActionsHandler(BaseHandler):
                     summary = gist['summary'],
                     created = datetime.datetime.fromtimestamp(gist['published']),
                     gist_id = gist['gist_id'],
-                    owner = user_info.key,
                     slug = slug,
                     article_type = gist['article_type'],
                 )
+                article.set_owner(user_info)
             
                 # update db
                 article.put()
@@ -416,7 +429,7 @@ class BlogArticleActionsHandler(BaseHandler):
     @user_required
     def delete(self, username=None, article_id = None):
         # pull the github token out of the social user db
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
 
         # delete the entry from the db
@@ -438,7 +451,7 @@ class BlogArticleActionsHandler(BaseHandler):
     @user_required
     def put(self, username=None, article_id = None):
         # pull the github token out of the social user db
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
 
         # what's the draft status set to?
@@ -461,7 +474,7 @@ class BlogArticleCreateHandler(BaseHandler):
     @user_required
     def get(self, username=None):
         # pull the github token out of the social user db
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
 
         # what do we do if we don't have a token or association?  auth 'em!
@@ -482,7 +495,7 @@ class BlogArticleCreateHandler(BaseHandler):
             return self.get()
 
         # pull the github token out of the social user db
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
         
         # load values out of the form
@@ -527,10 +540,10 @@ class BlogArticleCreateHandler(BaseHandler):
                 summary = summary,
                 created = datetime.datetime.fromtimestamp(published_epoch_gmt),
                 gist_id = gist_id,
-                owner = user_info.key,
                 slug = slug,
                 article_type = article_type,
             )
+            article.set_owner(user_info)
             article.put()
 
             self.add_message(_('Article "%s" successfully created!' % title), 'success')
@@ -549,7 +562,7 @@ class BlogArticleListHandler(BaseHandler):
     @user_required
     def get(self, username=None):
         # pull the github token out of the social user db
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
 
         # what do we do if we don't have a token or association?  auth 'em!
@@ -571,8 +584,11 @@ class BlogArticleListHandler(BaseHandler):
                 # setup channel to do page refresh in case they sync
                 channel_token = user_info.key.urlsafe()
                 refresh_channel = channel.create_channel(channel_token)
+                # flag articles github couldn't give us content for lately
+                gist_failures = github.get_gist_failures([article.gist_id for article in articles])
                 params = {
                     'articles': articles, 
+                    'gist_failures': gist_failures,
                     'refresh_channel': refresh_channel, 
                     'channel_token': channel_token, 
                     'username': username
@@ -586,7 +602,7 @@ class BlogArticleListHandler(BaseHandler):
 class BlogClearCacheHandler(BaseHandler):
     @user_required
     def get(self, article_id=None, username=None):
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
         article = models.Article.get_by_id(long(article_id))
 
         if article.owner == user_info.key and github.flush_gist_content(article.gist_id):
@@ -604,7 +620,7 @@ class BlogClearCacheHandler(BaseHandler):
 class BlogUserMenuHandler(BaseHandler):
     @user_required
     def get(self, menu_id=None):
-        user_info = models.User.get_by_id(long(self.user_id))
+        user_info = self.user_info
 
         if menu_id == 'newarticle':
             return self.redirect_to('blog-article-create', username=user_info.username)
@@ -619,9 +635,10 @@ class BlogUserMenuHandler(BaseHandler):
 # JOB SCHEDULER
 # schedule a job request for rebuilding user's articles from their github gists
 class BlogRefreshHandler(BaseHandler):
-    def task(self, user=None, channel_token=None):
+    def task(self, user=None, channel_token=None, full=''):
         # use both token and user to schedule job for updating user's articles from github gists
-        params = {'channel_token': channel_token, 'user': user, 'job_token': config.job_token}
+        # the run keeps this sync's per-gist tasks apart from the last one's
+        params = {'channel_token': channel_token, 'user': user, 'run': int(time.time()), 'page': 1, 'full': full, 'job_token': config.job_token}
         t = taskqueue.add(method='GET', url='/blog/buildlist/', params=params, transactional=True)
         return
 
@@ -631,12 +648,24 @@ class BlogRefreshHandler(BaseHandler):
         # refresh_token gets passed in URL and we use the current logged in user to start a job
         channel_token = self.request.get('channel_token')
         user = self.user_id
-        db.run_in_transaction(self.task, user, channel_token)
+        # a full sweep looks at every gist, rather than just the ones changed since the last sync
+        full = self.request.get('full')
+        db.run_in_transaction(self.task, user, channel_token, full)
         return
 
 
+# once the listing has been through every page and every gist task is done (see GistSync.record), remember
+# when the sync started so the next one can skip what this one saw, and tell the browser to reload
+def finish_sync(user, run, channel_token):
+    social_user = models.SocialUser.get_by_user_and_provider(ndb.Key(models.User, long(user)), 'github')
+    social_user.gists_synced = datetime.datetime.utcfromtimestamp(int(run))
+    social_user.put()
+    channel.send_message(channel_token, 'reload')
+
+
 # JOB HANDLER
-# handle a job request for rebuilding a user's articles from their github gists
+# handle a job request for rebuilding a user's articles from their github gists.  this lists a page
+# of the user's gists, queues a task for each gist that changed and then moves on to the next page
 class BlogBuildListHandler(BaseHandler):
     def get(self):
         # pull the github token out of the social user db and grab gists from github
@@ -644,44 +673,218 @@ class BlogBuildListHandler(BaseHandler):
             logging.info("Hacker attack on jobs!")
             return
         else: 
-            user_info = models.User.get_by_id(long(self.request.get('user')))
+            user = self.request.get('user')
+            run = self.request.get('run') or str(int(time.time()))
+            page = int(self.request.get('page') or 1)
+            full = self.request.get('full')
+            since = self.request.get('since')
+            channel_token = self.request.get('channel_token')
+
+            user_info = models.User.get_by_id(long(user))
             social_user = models.SocialUser.get_by_user_and_provider(user_info.key, 'github')
-            gists = github.get_user_gists(social_user.uid, social_user.access_token)
-
-            # update with the gists
-            for gist in gists:
-                article = models.Article.get_by_user_and_gist_id(user_info.key, gist['gist_id'])
-
-                if article:
-                    # update existing article with new data
-                    article.title = gist['title']
-                    article.summary = gist['summary']
-                    article.gist_id = gist['gist_id']
-                    article.article_type = gist['article_type']
-                    article.updated = datetime.datetime.fromtimestamp(gist['published'])
-                else:
-                    # we have a new article on our hands - insert
-                    # prep the slug
-                    slug = utils.slugify(gist['title'])
-                    article = models.Article(
-                        title = gist['title'],
-                        summary = gist['summary'],
-                        created = datetime.datetime.fromtimestamp(gist['published']),
-                        gist_id = gist['gist_id'],
-                        owner = user_info.key,
-                        slug = slug,
-                        article_type = gist['article_type'],
-                    )
-                
-                # update
-                article.put()
 
-                # flush memcache copy just in case we had it
-                github.flush_gist_content(article.gist_id)
-                                
-            # use the channel to tell the browser we are done
-            channel_token = self.request.get('channel_token')
-            channel.send_message(channel_token, 'reload')
+            # unless we're asked for a full sweep, only list what changed since the last sync started.
+            # worked out on the first page and passed along, so every page lists the same way
+            if page == 1 and not full and social_user.gists_synced:
+                since = calendar.timegm(social_user.gists_synced.timetuple())
+            params = {'channel_token': channel_token, 'user': user, 'run': run, 'page': page, 'full': full, 'since': since or '', 'job_token': config.job_token}
+
+            # leave the user's last few github calls for them, and sync once the limit resets
+            credential = ratelimit.credential_for_token(social_user.access_token)
+            if not ratelimit.has_spare(credential):
+                logging.info("holding off on syncing %s until the rate limit resets." % user_info.username)
+                taskqueue.add(method='GET', url='/blog/buildlist/', params=params, countdown=ratelimit.get_background_delay(credential))
+                return
+
+            since = since and datetime.datetime.utcfromtimestamp(int(since))
+            try:
+                gists, more = github.list_user_gists(social_user.uid, social_user.access_token, page, since)
+            except github.GistFetchError, e:
+                # fail the task so the queue tries the page again, rather than leaving the sync unfinished
+                logging.info(e)
+                self.response.set_status(503)
+                return
+
+            # only the gists that changed since we last saw them, and have a manifest, need a task
+            articles = models.Article.get_by_user_and_gist_ids(user_info.key, [gist['id'] for gist in gists])
+            known = dict((gist_id, article.gist_updated) for gist_id, article in articles.items())
+            tasks, gist_ids = [], []
+            for gist in github.changed_gists(gists, known):
+                manifest_file = gist['files'].get(config.gist_manifest_name)
+                if not manifest_file:
+                    continue
+
+                updated_at = gist.get('updated_at') or ''
+                gist_ids.append(gist['id'])
+                tasks.append(taskqueue.Task(
+                    # named, so a retried listing doesn't sync a gist twice
+                    name = 'sync-%s-%s-%s' % (run, gist['id'], re.sub('[^0-9]', '', updated_at)),
+                    method = 'GET',
+                    url = '/blog/syncgist/',
+                    params = {
+                        'user': user,
+                        'run': run,
+                        'channel_token': channel_token,
+                        'gist_id': gist['id'],
+                        'updated_at': updated_at,
+                        'manifest_url': manifest_file['raw_url'],
+                        'job_token': config.job_token,
+                    },
+                ))
+
+            # note the page's gists on the run before their tasks can start finishing
+            finished = models.GistSync.record(user, run, queued=gist_ids, listed=not more)
+
+            for i in range(0, len(tasks), 100):
+                try:
+                    taskqueue.Queue('gists').add(tasks[i:i + 100])
+                except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                    # a retry of this page, so the ones that made it last time are already queued
+                    for task in tasks[i:i + 100]:
+                        try:
+                            taskqueue.Queue('gists').add(task)
+                        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                            pass
+
+            if more:
+                # on to the next page
+                params['page'] = page + 1
+                try:
+                    taskqueue.add(name='list-%s-%s-%s' % (user, run, page + 1), method='GET', url='/blog/buildlist/', params=params)
+                except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                    pass
+            elif finished:
+                # nothing left for gist tasks to do
+                finish_sync(user, run, channel_token)
+            return
+
+    def post(self):
+        self.get()
+
+
+# JOB HANDLER
+# handle a job request for syncing one of a user's gists, queued by the listing above.  reads the
+# gist's manifest into its article and renders the gist, so it's ready when the browser reloads
+class BlogSyncGistHandler(BaseHandler):
+    def get(self):
+        if self.request.get('job_token') != config.job_token:
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            user = self.request.get('user')
+            run = self.request.get('run')
+            gist_id = self.request.get('gist_id')
+            user_info = models.User.get_by_id(long(user))
+
+            try:
+                gist = github.get_gist_article(gist_id, self.request.get('updated_at'), {'raw_url': self.request.get('manifest_url')})
+            except github.GistFetchError, e:
+                # fail the task so the queue tries it again, and leave it counted so the sync isn't
+                # recorded as done - otherwise the next one would list past this gist
+                logging.info(e)
+                self.response.set_status(503)
+                return
+
+            if gist:
+                models.Article.sync_gist(user_info, gist)
+
+                # render the new version now, rather than just flushing the old one
+                if not github.prerender_gist_content(gist_id):
+                    logging.info("couldn't render gist %s during sync, it'll refresh later." % gist_id)
+            else:
+                logging.info("gist %s doesn't have a manifest we can read." % gist_id)
+
+            # count this one as done, and reload the browser if it was the last
+            if models.GistSync.record(user, run, synced=[gist_id]):
+                finish_sync(user, run, self.request.get('channel_token'))
+            return
+
+    def post(self):
+        self.get()
+
+
+# JOB HANDLER
+# handle a job request for bringing a stale gist render up to date, queued by the github module
+class BlogRefreshGistHandler(BaseHandler):
+    def get(self):
+        if self.request.get('job_token') != config.job_token:
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            gist_id = self.request.get('gist_id')
+            try:
+                if not github.refresh_gist_content(gist_id):
+                    logging.info("refresh of gist %s didn't happen." % gist_id)
+            except github.GistFetchError, e:
+                # fail the task so the gists queue tries it again, up to its task_retry_limit
+                logging.info(e)
+                self.response.set_status(503)
+            return
+
+    def post(self):
+        self.get()
+
+
+# JOB HANDLER
+# copy owner details onto articles saved before articles kept them, a page at a time
+class BlogBackfillOwnersHandler(BaseHandler):
+    def get(self):
+        if self.request.get('job_token') != config.job_token:
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            articles, cursor = models.fetch_page(models.Article.query(), 100, self.request.get('cursor'))
+
+            owners = models.Article.get_owners(articles)
+            for article in articles:
+                owner_info = owners[article.owner]
+                if owner_info:
+                    article.set_owner(owner_info)
+            models.Lookup.put_multi(articles)
+
+            # on to the next page
+            if cursor:
+                params = {'cursor': cursor, 'job_token': config.job_token}
+                taskqueue.add(method='GET', url='/blog/backfillowners/', params=params)
+            else:
+                logging.info("done copying owners onto articles.")
+            return
+
+    def post(self):
+        self.get()
+
+
+# JOB HANDLER
+# warm the caches of published articles ahead of readers, newest first and a page at a time.  cron.yaml
+# starts a run, and each page queues the next one until the articles or the spare rate limit run out
+class BlogWarmCacheHandler(BaseHandler):
+    def get(self):
+        # cron requests come with a header app engine won't let anyone else send
+        if self.request.get('job_token') != config.job_token and self.request.headers.get('X-AppEngine-Cron') != 'true':
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            run_id = self.request.get('run')
+            warming = run_id and models.CacheWarming.get_by_id(long(run_id)) or models.CacheWarming()
+
+            articles, cursor = models.Article.get_feed_page(self.request.get('cursor'), config.cache_warmer_page_size)
+            cached, refreshed, held = github.warm_gist_contents([article.gist_id for article in articles if article.gist_id], config.cache_warmer_lead)
+            logging.info("warmed %s gists from the datastore and refreshed %s from github." % (len(cached), len(refreshed)))
+
+            warming.pages += 1
+            warming.cached += len(cached)
+            warming.refreshed.extend(refreshed)
+            warming.held.extend(held)
+
+            # on to the next page, unless github's out of spare calls - the next run will get to them
+            if cursor and not held:
+                warming.put()
+                params = {'run': warming.key.id(), 'cursor': cursor, 'job_token': config.job_token}
+                taskqueue.add(method='GET', url='/blog/warmcache/', params=params)
+            else:
+                warming.finished = datetime.datetime.now()
+                warming.put()
+                logging.info("done warming caches, %s gists refreshed and %s held." % (len(warming.refreshed), len(warming.held)))
             return
 
     def post(self):
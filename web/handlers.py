@@ -36,6 +36,7 @@ import html5lib
 
 # social login
 from lib.github import github
+from lib.github import ratelimit
 from lib.twitter import twitter
 from lib.markdown import markdown
 
@@ -89,7 +90,7 @@ class ContactHandler(BaseHandler):
         """ Returns a simple HTML for contact form """
 
         if self.user:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             if user_info.name or user_info.last_name:
                 self.form.name.data = user_info.name + " " + user_info.last_name
             if user_info.email:
@@ -165,10 +166,29 @@ class warmupHandler(BaseHandler):
         logging.info("Handling a warmup request.")
         return
 
+# JOB HANDLER
+# report the app's github rate limit budget for monitoring
+class GithubRateLimitHandler(BaseHandler):
+    def get(self):
+        if self.request.get('job_token') != config.job_token:
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            params = {
+                'budget': ratelimit.get_budget(ratelimit.APP),
+                'reserve': config.github_rate_limit_reserve,
+                'background_delay': ratelimit.get_background_delay(ratelimit.APP),
+            }
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(params))
+
+
 class HomeRequestHandler(BaseHandler):
     def get(self, username=None):
-        # load articles in from db and github, stuff them in an array
-        articles = models.Article.get_blog_posts(1)
+        # load articles in from db and github, stuff them in an array.  the sidebar's
+        # archive list loads alongside
+        archive_articles = models.Article.get_published_index_async('post', 5)
+        articles = models.Article.fill_owners(models.Article.get_blog_posts(1))
 
         # loop through all articles
         blogposts = []
@@ -178,13 +198,12 @@ class HomeRequestHandler(BaseHandler):
 
             # if github gist exists for the entry
             if raw_gist_content:
-                article_html = bleach.clean(raw_gist_content, config.bleach_tags, config.bleach_attributes)
+                article_html = raw_gist_content
                 article_title = bleach.clean(article.title)
                 
                 # created and by whom
                 date_format = "%a, %d %b %Y"
                 created = article.created.strftime(date_format)
-                owner_info = models.User.get_by_id(article.owner.id())
                 # build entry
                 entry = {
                     'created': created,
@@ -193,22 +212,20 @@ class HomeRequestHandler(BaseHandler):
                     'article_type': article.article_type, 
                     'article_html': article_html,
                     'article_slug': article.slug,
-                    'article_owner': owner_info.username,
+                    'article_owner': article.owner_username,
                     'article_host': self.request.host,
                 }   
                 blogposts.append(entry)
 
-        # show other recent articles in sidebar
-        articles = models.Article.get_blog_posts(5)
+        # show other recent articles in sidebar, the index has all we need for those
         archives = []
-        for article in articles:
-            owner_info = models.User.get_by_id(article.owner.id())
+        for article in models.Article.fill_owners(archive_articles.get_result()):
             article_title = bleach.clean(article.title)
             entry = {
                 'article_title': article_title,
-                'article_type': article.article_type, 
+                'article_type': 'post',
                 'article_slug': article.slug,
-                'article_owner': owner_info.username,
+                'article_owner': article.owner_username,
                 'article_host': self.request.host,
             }
             archives.append(entry)
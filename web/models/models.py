@@ -1,9 +1,118 @@
 from webapp2_extras.appengine.auth.models import User
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 import urllib, httplib2, simplejson
+import datetime
 import config
 import logging
 import yaml
+from lib import utils
+
+# fetch a page of results from a query, starting at the urlsafe cursor from the last page.
+# returns the results and the urlsafe cursor for the next page, or None on the last one.
+# options go on to the fetch, projection for one
+@ndb.tasklet
+def fetch_page_async(query, page_size, cursor=None, **options):
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+        # somebody's been editing urls, start them from the top
+        logging.info("bad cursor %s, starting from the first page." % cursor)
+        start_cursor = None
+
+    try:
+        results, next_cursor, more = yield query.fetch_page_async(page_size, start_cursor=start_cursor, **options)
+    except datastore_errors.BadRequestError:
+        if not start_cursor:
+            raise
+        # a good cursor, but from some other query
+        logging.info("cursor %s doesn't fit this query, starting from the first page." % cursor)
+        results, next_cursor, more = yield query.fetch_page_async(page_size, **options)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))
+
+
+def fetch_page(query, page_size, cursor=None, **options):
+    return fetch_page_async(query, page_size, cursor, **options).get_result()
+
+
+class Lookup(ndb.Model):
+    """
+    Points something we find entities by - a username, an email or a social
+    identity - at the entity, keyed by what we're looking for.  That makes
+    finding them a get by key, which is consistent and which ndb caches,
+    instead of a query.  Lookups can go stale, so check what they point at.
+    """
+    target = ndb.KeyProperty(indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def get_target_async(cls, lookup_id):
+        lookup = yield cls.get_by_id_async(lookup_id)
+        if lookup and lookup.target:
+            target = yield lookup.target.get_async()
+            raise ndb.Return(target)
+        raise ndb.Return(None)
+
+    @classmethod
+    def get_target(cls, lookup_id):
+        return cls.get_target_async(lookup_id).get_result()
+
+    @classmethod
+    def get_targets(cls, lookup_ids):
+        # batch version of get_target, in two get_multis.  returns the targets in lookup_ids order,
+        # None for the ones we don't have
+        lookups = ndb.get_multi([ndb.Key(cls, lookup_id) for lookup_id in lookup_ids])
+        keys = [lookup and lookup.target for lookup in lookups]
+        targets = dict(zip([key for key in keys if key], ndb.get_multi([key for key in keys if key])))
+        return [key and targets[key] for key in keys]
+
+    @classmethod
+    def set_target(cls, lookup_ids, target):
+        return ndb.put_multi([cls(id=lookup_id, target=target) for lookup_id in lookup_ids])
+
+    @classmethod
+    def update_targets(cls, entities):
+        # point the lookups of entities with get_lookup_ids() at them, in one batch.  entities remember
+        # the lookups we last wrote or read them with, and the ones that haven't changed are skipped
+        changed = [entity for entity in entities if entity.key and entity.get_lookup_ids() != getattr(entity, '_lookup_ids', None)]
+        if not changed:
+            return
+        ndb.put_multi([cls(id=lookup_id, target=entity.key) for entity in changed for lookup_id in entity.get_lookup_ids()])
+        for entity in changed:
+            entity._lookup_ids = entity.get_lookup_ids()
+
+    @classmethod
+    def put_multi(cls, entities):
+        # put_multi for entities that keep lookups, with their lookups written in one more batch
+        # rather than by each entity's put hook
+        for entity in entities:
+            entity._batch_lookups = True
+        try:
+            keys = ndb.put_multi(entities)
+        finally:
+            for entity in entities:
+                entity._batch_lookups = False
+        cls.update_targets(entities)
+        return keys
+
+    @classmethod
+    def post_put(cls, entity, future):
+        # for the _post_put_hook of entities that keep lookups.  nothing to point at if the put failed
+        if future.get_exception() or getattr(entity, '_batch_lookups', False):
+            return
+        cls.update_targets([entity])
+
+    @classmethod
+    def post_get(cls, future):
+        # for the _post_get_hook of entities that keep lookups, so a put that doesn't change them
+        # doesn't write them again
+        entity = None if future.get_exception() else future.get_result()
+        if entity:
+            entity._lookup_ids = entity.get_lookup_ids()
+
 
 class User(User):
     """
@@ -29,12 +138,45 @@ class User(User):
     
     @classmethod
     def get_by_email(cls, email):
+        user = Lookup.get_target('email:%s' % email)
+        # an old lookup keeps pointing at a user after they change their email
+        if user and user.email == email:
+            return user
         return cls.query(cls.email == email).get()
 
+    @classmethod
+    @ndb.tasklet
+    def get_by_username_async(cls, username):
+        user = yield Lookup.get_target_async('username:%s' % username)
+        if not (user and user.username == username):
+            user = yield cls.query(cls.username == username).get_async()
+        raise ndb.Return(user)
 
     @classmethod
     def get_by_username(cls, username):
-        return cls.query(cls.username == username).get()
+        return cls.get_by_username_async(username).get_result()
+
+    def get_lookup_ids(self):
+        lookup_ids = []
+        if self.username:
+            lookup_ids.append('username:%s' % self.username)
+        if self.email:
+            lookup_ids.append('email:%s' % self.email)
+        return lookup_ids
+
+    def _post_put_hook(self, future):
+        # keep the lookups pointing at whoever has the username and email now
+        Lookup.post_put(self, future)
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        Lookup.post_get(future)
+
+    def get_display_name(self):
+        # full name if they gave us one, otherwise their username
+        if not self.name:
+            return self.username
+        return "%s %s" % (self.name, self.last_name)
 
     def get_social_providers_names(self):
         social_user_objects = SocialUser.get_by_user(self.key)
@@ -85,19 +227,48 @@ class SocialUser(ndb.Model):
     access_token = ndb.StringProperty()
     extra_data = ndb.JsonProperty()
     screen_name = ndb.StringProperty()
+    # when the last sync of the user's gists started, for only asking github about gists changed since
+    gists_synced = ndb.DateTimeProperty(indexed=False)
     
     @classmethod
     def get_by_user(cls, user):
         return cls.query(cls.user == user).fetch()
 
+    @classmethod
+    @ndb.tasklet
+    def get_by_user_and_provider_async(cls, user, provider):
+        social_user = yield Lookup.get_target_async('%s:user:%s' % (provider, user.id()))
+        if not social_user:
+            social_user = yield cls.query(cls.user == user, cls.provider == provider).get_async()
+        raise ndb.Return(social_user)
+
     @classmethod
     def get_by_user_and_provider(cls, user, provider):
-        return cls.query(cls.user == user, cls.provider == provider).get()
+        return cls.get_by_user_and_provider_async(user, provider).get_result()
 
     @classmethod
     def get_by_provider_and_uid(cls, provider, uid):
+        social_user = Lookup.get_target('%s:%s' % (provider, uid))
+        if social_user:
+            return social_user
         return cls.query(cls.provider == provider, cls.uid == uid).get()
 
+    def get_lookup_ids(self):
+        return ['%s:%s' % (self.provider, self.uid), '%s:user:%s' % (self.provider, self.user.id())]
+
+    def _post_put_hook(self, future):
+        Lookup.post_put(self, future)
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        Lookup.post_get(future)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        social_user = key.get()
+        if social_user:
+            ndb.delete_multi([ndb.Key(Lookup, lookup_id) for lookup_id in social_user.get_lookup_ids()])
+
     @classmethod
     def check_unique_uid(cls, provider, uid):
         # pair (provider, uid) should be unique
@@ -138,7 +309,69 @@ class Article(ndb.Model):
     gist_id = ndb.StringProperty()
     public = ndb.BooleanProperty(default=False)
     draft = ndb.BooleanProperty(default=True)
-    
+    # github's updated_at for the gist when we last synced it, so syncs can skip what hasn't changed
+    gist_updated = ndb.StringProperty(indexed=False)
+    # copies of the owner's details, so pages that list articles don't have to load users
+    owner_username = ndb.StringProperty()
+    owner_name = ndb.StringProperty(indexed=False)
+    owner_email = ndb.StringProperty(indexed=False)
+
+    # what index pages need, for projection queries
+    INDEX_PROPERTIES = ['title', 'slug', 'created', 'owner_username']
+    # and what the blog and guide pages need - the html comes from the gist cache by gist_id
+    PAGE_PROPERTIES = INDEX_PROPERTIES + ['summary', 'gist_id']
+    # the user page has the owner already, but splits posts from guides
+    USER_PAGE_PROPERTIES = ['title', 'slug', 'created', 'summary', 'gist_id', 'article_type']
+
+    @classmethod
+    def get_projection(cls, properties):
+        # projections leave out articles that don't have every property, and need their index
+        # serving, so pages get whole articles until config.article_projections says otherwise
+        if config.article_projections:
+            return properties
+        return None
+
+    def set_owner(self, user_info):
+        self.owner = user_info.key
+        self.owner_username = user_info.username
+        self.owner_name = user_info.get_display_name()
+        self.owner_email = user_info.email
+
+    def get_lookup_ids(self):
+        lookup_ids = []
+        if self.owner_username and self.slug:
+            lookup_ids.append('article:%s/%s' % (self.owner_username, self.slug))
+        if self.owner and self.gist_id:
+            lookup_ids.append(self.get_gist_lookup_id(self.owner, self.gist_id))
+        return lookup_ids
+
+    @classmethod
+    def get_gist_lookup_id(cls, user, gist_id):
+        return 'gist:%s/%s' % (user.id(), gist_id)
+
+    def _post_put_hook(self, future):
+        # keep the username/slug lookup for the article page pointing here, including
+        # after the owner changes their username, and the one syncs find it by
+        Lookup.post_put(self, future)
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        Lookup.post_get(future)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        article = key.get()
+        if article:
+            ndb.delete_multi([ndb.Key(Lookup, lookup_id) for lookup_id in article.get_lookup_ids()])
+
+    @classmethod
+    def update_owner(cls, user_info):
+        # copy a user's changed details onto all of their articles
+        articles = cls.query().filter(cls.owner == user_info.key).fetch()
+        for article in articles:
+            article.set_owner(user_info)
+        return Lookup.put_multi(articles)
+
     @classmethod
     def delete_by_user(cls, user):
         article_query = cls.query().filter(cls.owner == user)
@@ -149,6 +382,51 @@ class Article(ndb.Model):
         return ndb.delete_multi(keys)
     
 
+    @classmethod
+    def get_by_user_and_gist_ids(cls, user, gist_ids):
+        # a user's articles for some of their gists, through the gist lookups, returns {gist_id: article}.
+        # articles from before gist lookups were kept aren't found until a sync gives them one
+        articles = Lookup.get_targets([cls.get_gist_lookup_id(user, gist_id) for gist_id in gist_ids])
+        return dict((gist_id, article) for gist_id, article in zip(gist_ids, articles)
+            if article and article.owner == user and article.gist_id == gist_id)
+
+    @classmethod
+    def sync_gist(cls, user_info, gist):
+        # create or update a user's article from a gist's manifest.  the article is found through its
+        # gist lookup inside a transaction, so a retried or overlapping sync of the gist can't make another
+        lookup_id = cls.get_gist_lookup_id(user_info.key, gist['gist_id'])
+        existing_key = None
+        if not Lookup.get_by_id(lookup_id):
+            # articles from before gist lookups were kept, which the query has long since caught up with
+            existing = cls.get_by_user_and_gist_id(user_info.key, gist['gist_id'])
+            existing_key = existing and existing.key
+        return cls._sync_gist(user_info, gist, lookup_id, existing_key)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _sync_gist(cls, user_info, gist, lookup_id, existing_key):
+        article = Lookup.get_target(lookup_id) or (existing_key and existing_key.get())
+        if article:
+            # update existing article with new data
+            article.title = gist['title']
+            article.summary = gist['summary']
+            article.article_type = gist['article_type']
+        else:
+            # we have a new article on our hands - insert
+            article = cls(
+                title = gist['title'],
+                summary = gist['summary'],
+                created = datetime.datetime.fromtimestamp(gist['published']),
+                gist_id = gist['gist_id'],
+                slug = utils.slugify(gist['title']),
+                article_type = gist['article_type'],
+            )
+        article.gist_updated = gist['updated_at']
+        article.set_owner(user_info)
+        # the put hook writes the gist lookup, in this transaction
+        article.put()
+        return article
+
     @classmethod
     def get_by_user_and_gist_id(cls, user, gist_id):
         # get() a single article by user/gist_id
@@ -162,11 +440,53 @@ class Article(ndb.Model):
         gists = article_query.fetch()
         return gists
 
+    @classmethod
+    def query_published(cls, article_type):
+        # public, non-draft articles of one type, newest first
+        return cls.query().filter(cls.article_type == article_type, cls.public == True, cls.draft == False).order(-cls.created)
+
+    @classmethod
+    def get_published(cls, article_type, num_articles=None):
+        return cls.get_published_async(article_type, num_articles).get_result()
+
+    @classmethod
+    def get_published_async(cls, article_type, num_articles=None):
+        return cls.query_published(article_type).fetch_async(limit=num_articles)
+
+    @classmethod
+    def get_published_index_async(cls, article_type, num_articles=None):
+        # lightweight rows for listing published articles, read straight out of the index.
+        # they're read only, and only have INDEX_PROPERTIES - not even article_type
+        return cls.query_published(article_type).fetch_async(limit=num_articles, projection=cls.get_projection(cls.INDEX_PROPERTIES))
+
+    @classmethod
+    def get_published_index(cls, article_type, num_articles=None):
+        return cls.get_published_index_async(article_type, num_articles).get_result()
+
+    @classmethod
+    def get_published_page(cls, article_type, cursor=None, page_size=config.blog_page_size):
+        # read only rows with just PAGE_PROPERTIES, out of the index
+        return fetch_page(cls.query_published(article_type), page_size, cursor, projection=cls.get_projection(cls.PAGE_PROPERTIES))
+
+    @classmethod
+    def get_feed_page(cls, cursor=None, page_size=config.blog_page_size):
+        # every non-draft article, newest first
+        article_query = cls.query().filter(cls.draft == False).order(-cls.created)
+        return fetch_page(article_query, page_size, cursor)
+
+    @classmethod
+    def get_user_page_async(cls, user, cursor=None, page_size=config.blog_page_size):
+        # a user's non-draft articles, newest first, as read only rows with USER_PAGE_PROPERTIES
+        article_query = cls.query().filter(cls.owner == user, cls.draft == False).order(-cls.created)
+        return fetch_page_async(article_query, page_size, cursor, projection=cls.get_projection(cls.USER_PAGE_PROPERTIES))
+
+    @classmethod
+    def get_user_page(cls, user, cursor=None, page_size=config.blog_page_size):
+        return cls.get_user_page_async(user, cursor, page_size).get_result()
+
     @classmethod
     def get_blog_posts(cls, num_articles=1):
-        article_query = cls.query().filter(cls.article_type == 'post', cls.public == True, cls.draft == False).order(-cls.created)
-        gists = article_query.fetch(limit=num_articles)
-        return gists
+        return cls.get_published('post', num_articles)
 
     @classmethod
     def get_by_user(cls, user):
@@ -184,4 +504,155 @@ class Article(ndb.Model):
     def get_by_user_and_slug(cls, user, slug):
         article_query = cls.query().filter(cls.owner == user, cls.slug == slug)
         gist = article_query.get()
-        return gist
\ No newline at end of file
+        return gist
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_username_and_slug_async(cls, username, slug):
+        # straight from the url to the article, and the owner details it carries
+        article = yield Lookup.get_target_async('article:%s/%s' % (username, slug))
+        if article and article.owner_username == username and article.slug == slug:
+            raise ndb.Return(article)
+
+        # no lookup yet, find it the long way round and leave one for next time
+        user = yield User.get_by_username_async(username)
+        if not user:
+            raise ndb.Return(None)
+        article = yield cls.query().filter(cls.owner == user.key, cls.slug == slug).get_async()
+        if article:
+            Lookup.set_target(article.get_lookup_ids(), article.key)
+        raise ndb.Return(article)
+
+    @classmethod
+    def get_by_username_and_slug(cls, username, slug):
+        return cls.get_by_username_and_slug_async(username, slug).get_result()
+
+    @classmethod
+    def get_owners(cls, articles):
+        # look up the owners of a list of articles in one get_multi, returns {owner key: user}.
+        # ndb's context cache keeps them for the rest of the request
+        keys = list(set(article.owner for article in articles))
+        return dict(zip(keys, ndb.get_multi(keys)))
+
+    @classmethod
+    def fill_owners(cls, articles):
+        # articles saved before they kept their owner's details don't have them until the
+        # /blog/backfillowners/ job gets to them, so copy them over from the owners meanwhile.
+        # projection queries only find articles that have them already, see get_projection
+        missing = [article for article in articles if not article.owner_username and article.owner]
+        if missing:
+            owners = cls.get_owners(missing)
+            for article in missing:
+                if owners[article.owner]:
+                    article.set_owner(owners[article.owner])
+        return articles
+
+
+class RenderedArticle(ndb.Model):
+    """
+    Datastore copy of a gist's rendered html, keyed by gist_id.  Sits behind
+    the memcache copy so an eviction or a flush doesn't send us back to Github.
+    """
+    # we keep our own memcache copy of the html, no need for ndb to keep another
+    _use_memcache = False
+
+    html = ndb.TextProperty()
+    # html after bleach has been through it, and a hash of the whitelist it used
+    sanitized = ndb.TextProperty()
+    whitelist = ndb.StringProperty()
+    revision = ndb.StringProperty()
+    # validators github sent with the gist, for conditional requests when we go stale
+    etag = ndb.StringProperty()
+    last_modified = ndb.StringProperty()
+    stale = ndb.BooleanProperty(default=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # when github last gave us the render or said it was still current.  flushes and sanitizing
+    # move updated but not this, so it's what we measure staleness from
+    rendered_at = ndb.DateTimeProperty(indexed=False)
+
+    def get_rendered_at(self):
+        # renders stored before rendered_at was kept only have updated to go by
+        return self.rendered_at or self.updated
+
+    def mark_rendered(self):
+        self.stale = False
+        self.rendered_at = datetime.datetime.now()
+
+    def is_fresh(self, lead=0):
+        # stale renders (flushed or too old) need a revision check against github
+        # lead counts renders going stale in the next lead seconds as stale already
+        if self.stale:
+            return False
+        max_age = datetime.timedelta(seconds=config.memcache_expire_time - lead)
+        return datetime.datetime.now() - self.get_rendered_at() < max_age
+
+    def is_servable(self):
+        # stale renders still get served while they refresh, up to config.gist_max_stale_time
+        max_age = datetime.timedelta(seconds=config.memcache_expire_time + config.gist_max_stale_time)
+        return datetime.datetime.now() - self.get_rendered_at() < max_age
+
+    def get_cache_time(self):
+        # seconds memcache can hold the render for - until it goes stale, or for a stale one only
+        # config.gist_stale_cache_time at a time, and never past the end of its servable window
+        age = datetime.datetime.now() - self.get_rendered_at()
+        age = age.days * 86400 + age.seconds
+        if not self.stale and age < config.memcache_expire_time:
+            return config.memcache_expire_time - age
+        servable_for = config.memcache_expire_time + config.gist_max_stale_time - age
+        # memcache takes 0 as forever
+        return max(1, min(config.gist_stale_cache_time, servable_for))
+
+    @classmethod
+    def mark_stale(cls, gist_id):
+        # returns the render, or None for a gist we haven't rendered
+        rendered = cls.get_by_id(gist_id)
+        if rendered:
+            rendered.stale = True
+            rendered.put()
+        return rendered
+
+
+class GistSync(ndb.Model):
+    """
+    A run syncing a user's gists from github, keyed by user id and run.  Keeps
+    the gists the listing queued tasks for and the ones those tasks finished,
+    so we know when the whole run is done.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    queued = ndb.StringProperty(repeated=True, indexed=False)
+    synced = ndb.StringProperty(repeated=True, indexed=False)
+    # the listing has been through every page, and the run has been seen through
+    listed = ndb.BooleanProperty(default=False, indexed=False)
+    finished = ndb.BooleanProperty(default=False, indexed=False)
+
+    @classmethod
+    def get_key(cls, user, run):
+        return ndb.Key(cls, '%s:%s' % (user, run))
+
+    @classmethod
+    @ndb.transactional(retries=10)
+    def record(cls, user, run, queued=(), synced=(), listed=False):
+        # add gists to a run's queued or synced ones, returns True for the one call that finishes it.
+        # gists are kept as sets, so retried listings and gist tasks don't count twice
+        sync = cls.get_key(user, run).get() or cls(key=cls.get_key(user, run))
+        sync.queued = sorted(set(sync.queued) | set(queued))
+        sync.synced = sorted(set(sync.synced) | set(synced))
+        sync.listed = sync.listed or listed
+        finished = sync.listed and not sync.finished and set(sync.queued) <= set(sync.synced)
+        sync.finished = sync.finished or finished
+        sync.put()
+        return finished
+
+
+class CacheWarming(ndb.Model):
+    """
+    A run of the cache warmer over the published articles, and what it did
+    with their gists along the way.
+    """
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+    pages = ndb.IntegerProperty(default=0, indexed=False)
+    # gists put back in memcache from their stored render, rendered with github, and left for later
+    cached = ndb.IntegerProperty(default=0, indexed=False)
+    refreshed = ndb.StringProperty(repeated=True, indexed=False)
+    held = ndb.StringProperty(repeated=True, indexed=False)
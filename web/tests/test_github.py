@@ -0,0 +1,354 @@
+'''
+Run the tests using testrunner.py script in the project root directory.
+
+Usage: testrunner.py SDK_PATH TEST_PATH
+Run unit tests for App Engine apps.
+
+SDK_PATH    Path to the SDK installation
+TEST_PATH   Path to package containing test modules
+
+'''
+import os
+import time
+import datetime
+import unittest
+import simplejson
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+from google.appengine.ext import testbed
+from mock import patch
+
+import config
+import web
+import web.models.models as models
+from lib.github import github
+from lib.github import ratelimit
+from lib.github import circuit
+from lib.github import client
+
+
+def raw_url(gist_id):
+    return 'https://gist.github.com/raw/%s/%s' % (gist_id, config.gist_markdown_name)
+
+
+def gist_responses(gist_id, version='abc123', markdown='# Hello'):
+    """Build the {url: (status, content)} github serves for a gist and its file."""
+    gist = {
+        'id': gist_id,
+        'history': [{'version': version}],
+        'files': {
+            config.gist_markdown_name: {
+                'raw_url': raw_url(gist_id),
+                'content': markdown,
+            },
+        },
+    }
+    return {
+        github.gist_url(gist_id): (200, simplejson.dumps(gist)),
+        raw_url(gist_id): (200, markdown),
+    }
+
+
+class FakeResult(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeRpc(ndb.Future):
+    """A urlfetch rpc that's answered with set_result, and can be yielded in a tasklet."""
+    def __init__(self, **kwargs):
+        ndb.Future.__init__(self)
+
+
+class GistContentTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_urlfetch_stub()
+        # the gists queue lives in queue.yaml
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(web.__file__), '..'))
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def mock_urlfetch(self, responses=None):
+        """Patch urlfetch so each url gets its (status, content) from responses.
+
+        Returns the list of fetched (url, headers)."""
+        responses = responses or {}
+        fetched = []
+        def make_fetch_call(rpc, url, headers=None, **kwargs):
+            fetched.append((url, headers))
+            rpc.set_result(FakeResult(*responses[url]))
+        patcher = patch.multiple('google.appengine.api.urlfetch', create_rpc=FakeRpc, make_fetch_call=make_fetch_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return fetched
+
+    def test_cache_miss_renders_and_stores(self):
+        fetched = self.mock_urlfetch(gist_responses('1'))
+        html = github.get_gist_content('1')
+        self.assertIn('<h1>Hello</h1>', html)
+        self.assertEqual(html, memcache.get(github.content_key('1', github.get_whitelist_hash())))
+        # contents came inline, so there's no trip to the raw file
+        self.assertEqual([github.gist_url('1')], [url for url, headers in fetched])
+        rendered = models.RenderedArticle.get_by_id('1')
+        self.assertEqual('abc123', rendered.revision)
+
+    def test_datastore_lookups_carry_on_while_github_is_out(self):
+        key = models.RenderedArticle(id='2', html='<p>stored</p>', revision='abc123').put()
+        ndb.get_context().clear_cache()
+        rpcs = []
+        def make_fetch_call(rpc, url, headers=None, **kwargs):
+            rpcs.append(rpc)
+        with patch.multiple('google.appengine.api.urlfetch', create_rpc=FakeRpc, make_fetch_call=make_fetch_call):
+            contents = github.get_gist_contents_async(['1'])
+            lookup = key.get_async()
+            eventloop.run()
+
+            # the lookup came back while github still has the gist request
+            self.assertEqual('<p>stored</p>', lookup.get_result().html)
+            self.assertEqual(1, len(rpcs))
+            self.assertFalse(contents.done())
+
+            rpcs[0].set_result(FakeResult(*gist_responses('1')[github.gist_url('1')]))
+            self.assertIn('<h1>Hello</h1>', contents.get_result()['1'])
+
+    def test_truncated_file_is_fetched_from_raw_url(self):
+        responses = gist_responses('1')
+        gist = simplejson.loads(responses[github.gist_url('1')][1])
+        gist['files'][config.gist_markdown_name].update({'truncated': True, 'content': '# Hel'})
+        responses[github.gist_url('1')] = (200, simplejson.dumps(gist))
+        fetched = self.mock_urlfetch(responses)
+        self.assertIn('<h1>Hello</h1>', github.get_gist_content('1'))
+        self.assertIn(raw_url('1'), [url for url, headers in fetched])
+
+    def test_memcache_flush_falls_through_to_datastore(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123').put()
+        fetched = self.mock_urlfetch()
+        self.assertEqual('<p>stored</p>', github.get_gist_content('1'))
+        self.assertEqual([], fetched)
+
+    def test_stale_render_is_served_while_it_refreshes(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', stale=True).put()
+        fetched = self.mock_urlfetch()
+        self.assertEqual('<p>stored</p>', github.get_gist_content('1'))
+        self.assertEqual([], fetched)
+        tasks = self.taskqueue_stub.get_filtered_tasks(url='/blog/refreshgist/', queue_names=['gists'])
+        self.assertEqual(1, len(tasks))
+
+        # a second reader doesn't queue another refresh
+        memcache.flush_all()
+        github.get_gist_content('1')
+        tasks = self.taskqueue_stub.get_filtered_tasks(url='/blog/refreshgist/', queue_names=['gists'])
+        self.assertEqual(1, len(tasks))
+
+    def test_stale_renders_queue_their_refreshes_together(self):
+        models.RenderedArticle(id='1', html='<p>one</p>', revision='abc123', stale=True).put()
+        models.RenderedArticle(id='2', html='<p>two</p>', revision='abc123', stale=True).put()
+        self.mock_urlfetch()
+        with patch.object(taskqueue.Queue, 'add', side_effect=taskqueue.UnknownQueueError) as add:
+            contents = github.get_gist_contents(['1', '2'])
+        self.assertEqual(1, add.call_count)
+        self.assertEqual({'1': '<p>one</p>', '2': '<p>two</p>'}, contents)
+
+    def test_page_gets_its_gists_when_storing_renders_fails(self):
+        models.RenderedArticle(id='1', html='<p>one</p>', revision='abc123').put()
+        self.mock_urlfetch(gist_responses('2'))
+        with patch.object(ndb, 'put_multi', side_effect=Exception('datastore timeout')):
+            contents = github.get_gist_contents(['1', '2'])
+        self.assertEqual('<p>one</p>', contents['1'])
+        self.assertIn('<h1>Hello</h1>', contents['2'])
+
+    def test_stale_render_is_only_cached_briefly(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', stale=True).put()
+        models.RenderedArticle(id='2', html='<p>fresh</p>', revision='abc123').put()
+        self.mock_urlfetch()
+        with patch.object(memcache, 'add_multi', wraps=memcache.add_multi) as add_multi:
+            github.get_gist_contents(['1', '2'])
+        times = dict((htmls.keys()[0], seconds) for (htmls, seconds), kwargs in add_multi.call_args_list)
+        self.assertLessEqual(times[github.content_key('1', github.get_whitelist_hash())], config.gist_stale_cache_time)
+        self.assertGreater(times[github.content_key('2', github.get_whitelist_hash())], config.gist_stale_cache_time)
+
+    def test_refresh_with_same_revision_is_not_rendered_again(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', stale=True).put()
+        fetched = self.mock_urlfetch(gist_responses('1', version='abc123'))
+        self.assertTrue(github.refresh_gist_content('1'))
+        self.assertEqual([github.gist_url('1')], [url for url, headers in fetched])
+        self.assertFalse(models.RenderedArticle.get_by_id('1').stale)
+
+    def test_stale_render_is_revalidated_with_etag(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', etag='"xyz"', stale=True).put()
+        fetched = self.mock_urlfetch({github.gist_url('1'): (304, '')})
+        self.assertTrue(github.refresh_gist_content('1'))
+        self.assertEqual('"xyz"', fetched[0][1]['If-None-Match'])
+        self.assertFalse(models.RenderedArticle.get_by_id('1').stale)
+
+    def test_flush_doesnt_restart_the_stale_clock(self):
+        rendered_at = datetime.datetime.now() - datetime.timedelta(seconds=config.memcache_expire_time + config.gist_max_stale_time + 60)
+        models.RenderedArticle(id='1', html='<p>old</p>', revision='old', rendered_at=rendered_at).put()
+        github.flush_gist_content('1')
+        rendered = models.RenderedArticle.get_by_id('1')
+        self.assertTrue(rendered.stale)
+        self.assertFalse(rendered.is_servable())
+
+        self.mock_urlfetch(gist_responses('1', version='new'))
+        self.assertIn('<h1>Hello</h1>', github.get_gist_content('1'))
+        self.assertTrue(models.RenderedArticle.get_by_id('1').is_fresh())
+
+    def test_render_past_stale_limit_is_fetched_right_away(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='old', stale=True).put()
+        with patch.object(models.RenderedArticle, 'is_servable', return_value=False):
+            self.mock_urlfetch(gist_responses('1', version='new'))
+            self.assertIn('<h1>Hello</h1>', github.get_gist_content('1'))
+
+    def test_missing_gist_is_negatively_cached(self):
+        fetched = self.mock_urlfetch({github.gist_url('1'): (404, '')})
+        self.assertFalse(github.get_gist_content('1'))
+        self.assertFalse(github.get_gist_content('1'))
+        self.assertEqual(1, len(fetched))
+        self.assertEqual({'1': github.GIST_NOT_FOUND}, github.get_gist_failures(['1', '2']))
+
+    def test_failed_refresh_leaves_stored_render_servable(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', stale=True).put()
+        self.mock_urlfetch({github.gist_url('1'): (502, '')})
+        self.assertRaises(github.GistFetchError, github.refresh_gist_content, '1')
+        self.assertEqual({}, github.get_gist_failures(['1']))
+
+        # and one cached by an older version doesn't keep readers from it either, or send them to github
+        github.cache_gist_failures({'1': github.GIST_UPSTREAM_ERROR})
+        fetched = self.mock_urlfetch()
+        self.assertEqual('<p>stored</p>', github.get_gist_content('1'))
+        self.assertEqual([], fetched)
+
+    def test_old_render_is_served_while_circuit_is_open(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123', stale=True).put()
+        circuit.trip()
+        fetched = self.mock_urlfetch()
+        with patch.object(models.RenderedArticle, 'is_servable', return_value=False):
+            self.assertEqual('<p>stored</p>', github.get_gist_content('1'))
+        self.assertFalse(github.get_gist_content('2'))
+        self.assertEqual([], fetched)
+        self.assertEqual({}, github.get_gist_failures(['1', '2']))
+
+    def test_circuit_opens_after_repeated_failures(self):
+        for i in range(config.github_circuit_failures):
+            circuit.after_call(False, False, 0)
+        self.assertTrue(circuit.is_open())
+        self.assertRaises(circuit.CircuitOpenError, circuit.before_call)
+
+    def test_only_one_request_fetches_a_missing_gist(self):
+        memcache.add('1', True, key_prefix='gist-lease:')
+        fetched = self.mock_urlfetch()
+        with patch('time.sleep', side_effect=lambda seconds: memcache.add(github.content_key('1', github.get_whitelist_hash()), '<p>theirs</p>')):
+            self.assertEqual('<p>theirs</p>', github.get_gist_content('1'))
+        self.assertEqual([], fetched)
+
+    def test_stored_render_is_sanitized_once(self):
+        models.RenderedArticle(id='1', html='<p>stored</p><script>alert(1)</script>', revision='abc123').put()
+        self.mock_urlfetch()
+        html = github.get_gist_content('1')
+        self.assertNotIn('<script>', html)
+        rendered = models.RenderedArticle.get_by_id('1')
+        self.assertEqual(html, rendered.sanitized)
+        self.assertEqual(github.get_whitelist_hash(), rendered.whitelist)
+
+    def test_flush_marks_stored_render_stale(self):
+        models.RenderedArticle(id='1', html='<p>stored</p>', revision='abc123').put()
+        github.flush_gist_content('1')
+        self.assertTrue(models.RenderedArticle.get_by_id('1').stale)
+
+    def test_unchanged_gists_are_left_out(self):
+        listing = [
+            {'id': '1', 'updated_at': 'monday', 'files': {}},
+            {'id': '2', 'updated_at': 'tuesday', 'files': {}},
+            {'id': '3', 'updated_at': 'tuesday', 'files': {}},
+        ]
+        gists = github.changed_gists(listing, {'1': 'monday', '2': 'monday'})
+        self.assertEqual(['2', '3'], [gist['id'] for gist in gists])
+
+    def test_listing_says_when_there_is_another_page(self):
+        next_link = {'Link': '<https://api.github.com/users/alice/gists?page=3>; rel="next"'}
+        with patch.object(client, 'request', return_value=FakeResult(200, '[]', next_link)) as request:
+            self.assertEqual(([], True), github.list_user_gists('alice', 'token', 2))
+        self.assertIn('page=2', request.call_args[0][0])
+        with patch.object(client, 'request', return_value=FakeResult(200, '[]')):
+            self.assertEqual(([], False), github.list_user_gists('alice', 'token', 3))
+
+    def test_user_gists_can_be_listed_since_the_last_sync(self):
+        with patch.object(client, 'request', return_value=FakeResult(200, '[]')) as request:
+            github.list_user_gists('alice', 'token', since=datetime.datetime(2013, 1, 2, 3, 4, 5))
+        self.assertIn('since=2013-01-02T03%3A04%3A05Z', request.call_args[0][0])
+
+    def test_warmer_caches_fresh_renders_and_refreshes_stale_ones(self):
+        models.RenderedArticle(id='1', html='<p>fresh</p>', revision='abc123').put()
+        models.RenderedArticle(id='2', html='<p>stale</p>', revision='old', stale=True).put()
+        fetched = self.mock_urlfetch(gist_responses('2', version='new'))
+        cached, refreshed, held = github.warm_gist_contents(['1', '2'])
+        self.assertEqual((['1'], ['2'], []), (cached, refreshed, held))
+        self.assertEqual([github.gist_url('2')], [url for url, headers in fetched])
+        self.assertEqual('<p>fresh</p>', memcache.get(github.content_key('1', github.get_whitelist_hash())))
+        self.assertIn('<h1>Hello</h1>', memcache.get(github.content_key('2', github.get_whitelist_hash())))
+
+    def test_warmer_holds_off_without_spare_rate_limit(self):
+        fetched = self.mock_urlfetch()
+        with patch.object(ratelimit, 'has_spare', return_value=False):
+            self.assertEqual(([], [], ['1']), github.warm_gist_contents(['1']))
+        self.assertEqual([], fetched)
+
+    def test_batch_fetches_only_misses(self):
+        memcache.add(github.content_key('1', github.get_whitelist_hash()), '<p>cached</p>')
+        responses = gist_responses('2')
+        responses[github.gist_url('3')] = (404, '')
+        fetched = self.mock_urlfetch(responses)
+        contents = github.get_gist_contents(['1', '2', '3'])
+        self.assertEqual('<p>cached</p>', contents['1'])
+        self.assertIn('<h1>Hello</h1>', contents['2'])
+        self.assertFalse(contents['3'])
+        self.assertNotIn(github.gist_url('1'), [url for url, headers in fetched])
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def record(self, remaining, reset_in=3600):
+        headers = {
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(time.time()) + reset_in),
+        }
+        ratelimit.record(github.gist_url('1'), headers)
+
+    def test_budget_is_tracked_per_credential(self):
+        self.record(4000)
+        self.assertEqual(4000, ratelimit.get_budget(ratelimit.APP)['remaining'])
+        self.assertIsNone(ratelimit.get_budget(ratelimit.credential_for_token('token')))
+
+    def test_background_work_slows_down_as_budget_shrinks(self):
+        self.record(config.github_rate_limit_reserve + 7200)
+        self.assertEqual(0, ratelimit.get_background_delay())
+        self.record(config.github_rate_limit_reserve + 60)
+        self.assertTrue(ratelimit.has_spare())
+        self.assertGreater(ratelimit.get_background_delay(), 0)
+
+    def test_reserve_is_left_for_readers(self):
+        self.record(config.github_rate_limit_reserve, reset_in=600)
+        self.assertFalse(ratelimit.has_spare())
+        self.assertAlmostEqual(600, ratelimit.get_background_delay(), delta=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,16 +15,21 @@ import unittest
 import webapp2
 import os
 import re
+import datetime
 import webtest
 from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
 from webapp2_extras import auth
 from mock import Mock
 from mock import patch
+from google.appengine.api import memcache
+import simplejson
 
 import config
 import routes
 import web
-import web.models as models
+import web.models.models as models
+from lib.github import client
 from lib import utils
 from lib import captcha
 from lib import i18n
@@ -61,10 +66,12 @@ class AppTest(unittest.TestCase):
         # activate GAE stubs
         self.testbed = testbed.Testbed()
         self.testbed.activate()
-        self.testbed.init_datastore_v3_stub()
+        # high replication, for the cross group transactions gist syncs use
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
         self.testbed.init_memcache_stub()
         self.testbed.init_urlfetch_stub()
-        self.testbed.init_taskqueue_stub()
+        # the gists queue lives in queue.yaml
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(web.__file__), '..'))
         self.testbed.init_mail_stub()
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
         self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
@@ -267,6 +274,191 @@ class AppTest(unittest.TestCase):
         message = self.get_sent_messages(to=config.contact_recipient)[0]
         self.assertIn('help', message.body.payload)
 
+    def test_gist_sync_fans_out_over_every_page(self):
+        user = self.create_github_user()
+        pages = {
+            1: ([self.listed_gist('1')], True),
+            2: ([self.listed_gist('2'), {'id': '3', 'updated_at': 'monday', 'files': {}}], False),
+        }
+        with self.mock_github(pages) as send_message:
+            self.get('/blog/buildlist/', params={'user': user.key.id(), 'run': 1, 'job_token': config.job_token})
+            self.execute_tasks(url='/blog/buildlist/')
+
+            # a retried page doesn't queue or count its gists again
+            self.get('/blog/buildlist/', params={'user': user.key.id(), 'run': 1, 'page': 2, 'job_token': config.job_token})
+            sync = models.GistSync.get_key(user.key.id(), 1).get()
+            self.assertEqual(['1', '2'], sync.queued)
+            self.assertTrue(sync.listed)
+            self.assertFalse(send_message.called)
+
+            # losing memcache along the way doesn't finish the run early
+            memcache.flush_all()
+
+            self.execute_tasks(url='/blog/syncgist/', queue_name='gists', expect_tasks=2)
+            self.assertEqual(1, send_message.call_count)
+
+        articles = models.Article.get_by_user(user.key)
+        self.assertEqual(['1', '2'], sorted(article.gist_id for article in articles))
+        self.assertEqual('alice', articles[0].owner_username)
+        social_user = models.SocialUser.get_by_user_and_provider(user.key, 'github')
+        self.assertEqual(datetime.datetime.utcfromtimestamp(1), social_user.gists_synced)
+
+    def test_gist_sync_updates_existing_article(self):
+        user = self.create_github_user()
+        article = models.Article(gist_id='1', title='Old', slug='old', gist_updated='sunday')
+        article.set_owner(user)
+        article.put()
+        with self.mock_github({}):
+            params = {'user': user.key.id(), 'run': 1, 'gist_id': '1', 'updated_at': 'monday', 'manifest_url': self.manifest_url('1'), 'job_token': config.job_token}
+            self.get('/blog/syncgist/', params=params)
+
+        articles = models.Article.get_by_user(user.key)
+        self.assertEqual(1, len(articles))
+        self.assertEqual('Gist 1', articles[0].title)
+        self.assertEqual('monday', articles[0].gist_updated)
+
+    def test_gist_listing_is_retried_when_github_fails(self):
+        user = self.create_github_user()
+        with patch.object(client, 'request', return_value=Mock(status_code=502, headers={}, content='')):
+            self.get('/blog/buildlist/', params={'user': user.key.id(), 'run': 1, 'job_token': config.job_token}, status=503)
+        self.assertIsNone(models.GistSync.get_key(user.key.id(), 1).get())
+
+    def test_gist_sync_is_retried_when_github_fails(self):
+        user = self.create_github_user()
+        models.GistSync.record(user.key.id(), 1, queued=['1'], listed=True)
+        with patch.object(client, 'request', return_value=Mock(status_code=502, headers={}, content='')):
+            params = {'user': user.key.id(), 'run': 1, 'gist_id': '1', 'updated_at': 'monday', 'manifest_url': self.manifest_url('1'), 'job_token': config.job_token}
+            self.get('/blog/syncgist/', params=params, status=503)
+
+        self.assertEqual([], models.Article.get_by_user(user.key))
+        self.assertEqual([], models.GistSync.get_key(user.key.id(), 1).get().synced)
+        self.assertIsNone(models.SocialUser.get_by_user_and_provider(user.key, 'github').gists_synced)
+
+    def test_blog_pages_link_to_older_articles(self):
+        self.create_articles(config.blog_page_size + 1)
+        with self.mock_gist_contents():
+            response = self.get('/blog/')
+            self.assertIn('Post 0<', response)
+            self.assertNotIn('Post %s<' % config.blog_page_size, response)
+            self.assertNotIn('Newest', response)
+            cursor = re.search('href="\?cursor=([^"]+)"', response.body).group(1)
+
+            response = self.get('/blog/', params={'cursor': cursor})
+            self.assertIn('Post %s<' % config.blog_page_size, response)
+            self.assertIn('Newest', response)
+            self.assertNotIn('?cursor=', response)
+
+    def test_cursor_from_another_query_starts_from_the_first_page(self):
+        self.create_articles(2)
+        articles, cursor = models.Article.get_feed_page(page_size=1)
+        with self.mock_gist_contents():
+            response = self.get('/blog/', params={'cursor': cursor})
+        self.assertIn('Post 0<', response)
+
+    def test_feed_fills_up_past_articles_without_content(self):
+        self.create_articles(config.blog_page_size + 2)
+        # the newest two have nothing on github
+        with self.mock_gist_contents(missing=['0', '1']):
+            response = self.get('/blog/feed/rss/')
+        self.assertEqual(config.blog_page_size, response.body.count('<item>'))
+        self.assertNotIn('Post 1<', response)
+        self.assertIn('Post %s<' % (config.blog_page_size + 1), response)
+
+    def test_cache_warmer_only_runs_for_cron_and_jobs(self):
+        self.create_articles(1)
+        with patch('lib.github.github.warm_gist_contents', return_value=(['0'], [], [])) as warm_gist_contents:
+            self.get('/blog/warmcache/')
+            self.assertFalse(warm_gist_contents.called)
+            self.assertEqual(0, models.CacheWarming.query().count())
+
+            self.get('/blog/warmcache/', headers=dict(self.headers, **{'X-AppEngine-Cron': 'true'}))
+            self.assertEqual(1, warm_gist_contents.call_count)
+        warming = models.CacheWarming.query().get()
+        self.assertEqual((1, 1), (warming.pages, warming.cached))
+        self.assertIsNotNone(warming.finished)
+
+    @patch.object(config, 'cache_warmer_page_size', 2)
+    def test_cache_warmer_chains_pages_into_one_run(self):
+        self.create_articles(3)
+        # gists 0 and 2 come from the datastore, and 1 from github
+        def warm_gist_contents(gist_ids, lead):
+            return [gist_id for gist_id in gist_ids if gist_id != '1'], [gist_id for gist_id in gist_ids if gist_id == '1'], []
+        with patch('lib.github.github.warm_gist_contents', side_effect=warm_gist_contents):
+            self.get('/blog/warmcache/', params={'job_token': config.job_token})
+            warming = models.CacheWarming.query().get()
+            self.assertIsNone(warming.finished)
+            self.execute_tasks(url='/blog/warmcache/')
+        self.assertEqual([], self.taskqueue_stub.get_filtered_tasks(queue_names=['default']))
+
+        warming = warming.key.get()
+        self.assertEqual((2, 2, ['1'], []), (warming.pages, warming.cached, warming.refreshed, warming.held))
+        self.assertIsNotNone(warming.finished)
+        self.assertEqual(1, models.CacheWarming.query().count())
+
+    @patch.object(config, 'cache_warmer_page_size', 2)
+    def test_cache_warmer_stops_when_github_cant_spare_the_calls(self):
+        self.create_articles(3)
+        with patch('lib.github.github.warm_gist_contents', side_effect=lambda gist_ids, lead: ([], [], gist_ids)):
+            self.get('/blog/warmcache/', params={'job_token': config.job_token})
+        self.assertEqual([], self.taskqueue_stub.get_filtered_tasks(queue_names=['default']))
+
+        warming = models.CacheWarming.query().get()
+        self.assertEqual((1, ['0', '1']), (warming.pages, sorted(warming.held)))
+        self.assertIsNotNone(warming.finished)
+
+    def create_articles(self, count, article_type='post'):
+        """Publish count articles by alice, the first one newest, with the gist_id of their position."""
+        user = models.User(username='alice', email='alice@example.com')
+        user.put()
+        now = datetime.datetime.utcnow()
+        for i in range(count):
+            article = models.Article(title='Post %s' % i, slug='post-%s' % i, summary='Hello', gist_id=str(i), article_type=article_type,
+                public=True, draft=False, created=now - datetime.timedelta(minutes=i))
+            article.set_owner(user)
+            article.put()
+
+    def mock_gist_contents(self, missing=()):
+        """Serve every gist's html from the gist cache, except the missing ones."""
+        def get_gist_contents(gist_ids):
+            return dict((gist_id, gist_id not in missing and '<p>gist %s</p>' % gist_id) for gist_id in gist_ids)
+        return patch('lib.github.github.get_gist_contents', side_effect=get_gist_contents)
+
+    def create_github_user(self):
+        user = models.User(username='alice', email='alice@example.com')
+        user.put()
+        models.SocialUser(user=user.key, provider='github', uid='alice', access_token='token').put()
+        return user
+
+    def manifest_url(self, gist_id):
+        return 'https://gist.github.com/raw/%s/%s' % (gist_id, config.gist_manifest_name)
+
+    def listed_gist(self, gist_id):
+        return {'id': gist_id, 'updated_at': 'monday', 'files': {config.gist_manifest_name: {'raw_url': self.manifest_url(gist_id)}}}
+
+    def mock_github(self, pages):
+        """Serve gist listing pages and manifests from github, and skip rendering the gists.
+
+        pages is {page: (gists, more)}.  Returns a patcher whose mock stands in for channel.send_message."""
+        def request(uri, **kwargs):
+            response = Mock(status_code=200, headers={})
+            page = re.search('[?&]page=(\d+)', uri)
+            if page:
+                gists, more = pages[int(page.group(1))]
+                response.content = simplejson.dumps(gists)
+                if more:
+                    response.headers['Link'] = '<https://api.github.com/next>; rel="next"'
+            else:
+                gist_id = uri.split('/')[-2]
+                response.content = 'title: Gist %s\nsummary: Hello\npublished: 1\ntype: post' % gist_id
+            return response
+        request_patcher = patch.object(client, 'request', side_effect=request)
+        request_patcher.start()
+        self.addCleanup(request_patcher.stop)
+        render_patcher = patch('lib.github.github.prerender_gist_content', return_value=True)
+        render_patcher.start()
+        self.addCleanup(render_patcher.stop)
+        return patch('web.blog.bloghandlers.channel.send_message')
+
     def get(self, *args, **kwargs):
         """Wrap webtest get with nicer defaults"""
         if 'headers' not in kwargs:
@@ -436,7 +628,10 @@ class AppTest(unittest.TestCase):
 
     def execute_tasks(self, url=None, queue_name='default', expect_tasks=1):
         """Filter and execute tasks accumulated in the task queue stub."""
-        tasks = self.taskqueue_stub.get_filtered_tasks(url=url, queue_names=[queue_name])
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=[queue_name])
+        if url:
+            # GET tasks carry their params in the url
+            tasks = [task for task in tasks if task.url.split('?')[0] == url]
         if expect_tasks:
             self.assertEqual(expect_tasks, len(tasks),
                     'expect {} task(s) in queue, found {}: {}'.
@@ -0,0 +1,237 @@
+'''
+Run the tests using testrunner.py script in the project root directory.
+
+Usage: testrunner.py SDK_PATH TEST_PATH
+Run unit tests for App Engine apps.
+
+SDK_PATH    Path to the SDK installation
+TEST_PATH   Path to package containing test modules
+
+'''
+import unittest
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from mock import patch
+
+import config
+import web.models.models as models
+
+
+class ArticleTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_owners_are_fetched_in_one_batch(self):
+        alice = models.User(username='alice').put()
+        bob = models.User(username='bob').put()
+        articles = [models.Article(owner=owner) for owner in (alice, bob, alice)]
+        with patch.object(ndb, 'get_multi', wraps=ndb.get_multi) as get_multi:
+            owners = models.Article.get_owners(articles)
+        self.assertEqual(1, get_multi.call_count)
+        self.assertEqual('alice', owners[alice].username)
+        self.assertEqual('bob', owners[bob].username)
+
+    def test_owner_changes_are_copied_onto_articles(self):
+        user = models.User(username='alice', email='alice@example.com')
+        user.put()
+        article = models.Article()
+        article.set_owner(user)
+        article.put()
+        self.assertEqual('alice', article.owner_name)
+
+        user.name, user.last_name = 'Alice', 'Smith'
+        user.put()
+        models.Article.update_owner(user)
+        article = article.key.get()
+        self.assertEqual('alice', article.owner_username)
+        self.assertEqual('Alice Smith', article.owner_name)
+        self.assertEqual('alice@example.com', article.owner_email)
+
+    def test_articles_from_before_owner_copies_get_them_from_their_owner(self):
+        user = models.User(username='alice', email='alice@example.com')
+        user.put()
+        models.Article(owner=user.key, slug='hello').put()
+        articles = models.Article.fill_owners(models.Article.query().fetch())
+        self.assertEqual('alice', articles[0].owner_username)
+        self.assertEqual('alice@example.com', articles[0].owner_email)
+
+    def test_only_published_articles_of_a_type_are_listed(self):
+        models.Article(slug='post', article_type='post', public=True, draft=False).put()
+        models.Article(slug='guide', article_type='guide', public=True, draft=False).put()
+        models.Article(slug='draft', article_type='guide', public=True, draft=True).put()
+        models.Article(slug='private', article_type='guide', public=False, draft=False).put()
+        self.assertEqual(['guide'], [article.slug for article in models.Article.get_published('guide')])
+
+    def test_published_articles_are_paged_with_cursors(self):
+        for i in range(5):
+            models.Article(slug=str(i), article_type='post', public=True, draft=False).put()
+        articles, cursor = models.Article.get_published_page('post', page_size=3)
+        self.assertEqual(3, len(articles))
+        articles, cursor = models.Article.get_published_page('post', cursor, page_size=3)
+        self.assertEqual(2, len(articles))
+        self.assertIsNone(cursor)
+
+    def test_bad_cursor_starts_from_the_first_page(self):
+        models.Article(slug='post', article_type='post', public=True, draft=False).put()
+        articles, cursor = models.Article.get_published_page('post', 'not-a-cursor')
+        self.assertEqual(['post'], [article.slug for article in articles])
+
+    @patch.object(config, 'article_projections', True)
+    def test_page_rows_come_from_a_projection(self):
+        user = models.User(username='alice')
+        user.put()
+        article = models.Article(title='Hello', slug='hello', summary='Hi', gist_id='1', article_type='guide', public=True, draft=False)
+        article.set_owner(user)
+        article.put()
+        articles, cursor = models.Article.get_published_page('guide')
+        self.assertEqual(('Hi', '1'), (articles[0].summary, articles[0].gist_id))
+        self.assertEqual(tuple(models.Article.PAGE_PROPERTIES), articles[0]._projection)
+        articles, cursor = models.Article.get_user_page(user.key)
+        self.assertEqual('guide', articles[0].article_type)
+        self.assertEqual(tuple(models.Article.USER_PAGE_PROPERTIES), articles[0]._projection)
+
+    @patch.object(config, 'article_projections', True)
+    def test_index_rows_come_from_a_projection(self):
+        models.Article(title='Hello', slug='hello', summary='Long summary', article_type='post', owner_username='alice', public=True, draft=False).put()
+        articles = models.Article.get_published_index('post')
+        self.assertEqual('hello', articles[0].slug)
+        self.assertEqual(tuple(models.Article.INDEX_PROPERTIES), articles[0]._projection)
+
+    def test_pages_get_whole_articles_until_projections_are_on(self):
+        # articles from before owner copies aren't in the projection indexes
+        models.Article(title='Hello', slug='hello', article_type='post', public=True, draft=False).put()
+        articles, cursor = models.Article.get_published_page('post')
+        self.assertEqual('hello', articles[0].slug)
+        self.assertFalse(articles[0]._projection)
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_users_are_found_by_key(self):
+        user = models.User(username='alice', email='alice@example.com')
+        user.put()
+        with patch.object(models.User, 'query') as query:
+            self.assertEqual(user.key, models.User.get_by_username('alice').key)
+            self.assertEqual(user.key, models.User.get_by_email('alice@example.com').key)
+        self.assertFalse(query.called)
+
+    def test_old_username_lookup_is_ignored(self):
+        user = models.User(username='alice')
+        user.put()
+        user.username = 'bob'
+        user.put()
+        self.assertEqual(user.key, models.User.get_by_username('bob').key)
+        self.assertIsNone(models.User.get_by_username('alice'))
+
+    def test_social_users_are_found_by_key(self):
+        user = models.User(username='alice').put()
+        social_user = models.SocialUser(user=user, provider='github', uid='alice')
+        social_user.put()
+        with patch.object(models.SocialUser, 'query') as query:
+            self.assertEqual(social_user.key, models.SocialUser.get_by_provider_and_uid('github', 'alice').key)
+            self.assertEqual(social_user.key, models.SocialUser.get_by_user_and_provider(user, 'github').key)
+        self.assertFalse(query.called)
+
+        social_user.key.delete()
+        self.assertIsNone(models.Lookup.get_by_id('github:alice'))
+
+    def test_unchanged_lookups_are_not_written_again(self):
+        key = models.User(username='alice').put()
+        user = key.get()
+        user.name = 'Alice'
+        with patch.object(ndb, 'put_multi', wraps=ndb.put_multi) as put_multi:
+            user.put()
+        self.assertFalse(put_multi.called)
+
+    def test_owner_changes_write_lookups_in_one_batch(self):
+        user = models.User(username='alice')
+        user.put()
+        for slug in ('one', 'two', 'three'):
+            article = models.Article(slug=slug)
+            article.set_owner(user)
+            article.put()
+        user.username = 'bob'
+        with patch.object(ndb, 'put_multi', wraps=ndb.put_multi) as put_multi:
+            models.Article.update_owner(user)
+        # the articles, then their lookups
+        self.assertEqual(2, put_multi.call_count)
+        self.assertEqual('three', models.Lookup.get_target('article:bob/three').slug)
+
+    def test_lookup_without_a_target_finds_nothing(self):
+        models.Lookup(id='username:alice').put()
+        self.assertIsNone(models.User.get_by_username('alice'))
+
+    def test_article_is_found_by_username_and_slug(self):
+        user = models.User(username='alice')
+        user.put()
+        article = models.Article(slug='hello')
+        article.set_owner(user)
+        article.put()
+        with patch.object(models.Article, 'query') as query:
+            self.assertEqual(article.key, models.Article.get_by_username_and_slug('alice', 'hello').key)
+        self.assertFalse(query.called)
+
+        # and under their new username once they change it
+        user.username = 'bob'
+        user.put()
+        models.Article.update_owner(user)
+        self.assertEqual(article.key, models.Article.get_by_username_and_slug('bob', 'hello').key)
+        self.assertIsNone(models.Article.get_by_username_and_slug('alice', 'hello'))
+
+
+class GistSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries never see the latest writes, like a busy high replication datastore
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0))
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def gist(self, title):
+        return {'title': title, 'summary': 'Hello', 'published': 1, 'article_type': 'post', 'gist_id': '1', 'updated_at': 'monday'}
+
+    def test_syncing_a_gist_again_finds_its_article_by_key(self):
+        user = models.User(username='alice')
+        user.put()
+        article = models.Article.sync_gist(user, self.gist('Hello'))
+        self.assertEqual(article.key, models.Article.sync_gist(user, self.gist('Hello again')).key)
+        self.assertEqual('Hello again', article.key.get().title)
+
+    def test_articles_from_before_gist_lookups_are_still_found(self):
+        user = models.User(username='alice')
+        user.put()
+        article = models.Article(gist_id='1', owner=user.key, title='Old')
+        article.put()
+        models.Lookup.get_by_id(models.Article.get_gist_lookup_id(user.key, '1')).key.delete()
+        with patch.object(models.Article, 'get_by_user_and_gist_id', return_value=article):
+            self.assertEqual(article.key, models.Article.sync_gist(user, self.gist('New')).key)
+
+
+    def test_listing_finds_synced_articles_by_key(self):
+        user = models.User(username='alice')
+        user.put()
+        article = models.Article.sync_gist(user, self.gist('Hello'))
+        articles = models.Article.get_by_user_and_gist_ids(user.key, ['1', '2'])
+        self.assertEqual({'1': article.key}, dict((gist_id, found.key) for gist_id, found in articles.items()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -191,7 +191,7 @@ class CallbackSocialLoginHandler(BaseHandler):
 
             if self.user:
                 # user is already logged in so we set a new association with twitter
-                user_info = models.User.get_by_id(long(self.user_id))
+                user_info = self.user_info
                 if models.SocialUser.check_unique(user_info.key, 'twitter', str(user_data['id'])):
                     social_user = models.SocialUser(
                         user = user_info.key,
@@ -252,7 +252,7 @@ class CallbackSocialLoginHandler(BaseHandler):
             
             if self.user:
                 # user is already logged in so we set a new association with github
-                user_info = models.User.get_by_id(long(self.user_id))
+                user_info = self.user_info
                 if models.SocialUser.check_unique(user_info.key, 'github', str(user_data['login'])):
                     social_user = models.SocialUser(
                         user = user_info.key,
@@ -325,7 +325,7 @@ class CallbackSocialLoginHandler(BaseHandler):
                 return self.redirect_to('login')
             if self.user:
                 # add social account to user
-                user_info = models.User.get_by_id(long(self.user_id))
+                user_info = self.user_info
                 if models.SocialUser.check_unique(user_info.key, provider_name, uid):
                     social_user = models.SocialUser(
                         user = user_info.key,
@@ -374,7 +374,7 @@ class DeleteSocialProviderHandler(BaseHandler):
     @user_required
     def get(self, provider_name):
         if self.user:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             social_user = models.SocialUser.get_by_user_and_provider(user_info.key, provider_name)
             if social_user:
                 social_user.key.delete()
@@ -551,7 +551,7 @@ class EditProfileHandler(BaseHandler):
         if self.user:
             logging.info("logged in")
         if self.user:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             self.form.username.data = user_info.username
             self.form.name.data = user_info.name
             self.form.last_name.data = user_info.last_name
@@ -583,7 +583,9 @@ class EditProfileHandler(BaseHandler):
         google_plus_profile = self.form.google_plus_profile.data.strip()
         
         try:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
+            # what the user's articles currently show for them
+            display_name = (user_info.username, user_info.get_display_name())
 
             try:
                 message=''
@@ -618,6 +620,9 @@ class EditProfileHandler(BaseHandler):
                 user_info.gravatar_url=gravatar_url
                 user_info.google_plus_profile=google_plus_profile
                 user_info.put()
+                # keep the copy on their articles in step
+                if display_name != (user_info.username, user_info.get_display_name()):
+                    models.Article.update_owner(user_info)
                 message+= " " + _('Thanks, your settings have been saved.  You may now dance.')
                 self.add_message(message, 'success')
                 return self.get()
@@ -659,7 +664,7 @@ class EditPasswordHandler(BaseHandler):
         password = self.form.password.data.strip()
 
         try:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             auth_id = "own:%s" % user_info.username
 
             # Password to SHA512
@@ -726,7 +731,7 @@ class EditEmailHandler(BaseHandler):
 
         params = {}
         if self.user:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             params['current_email'] = user_info.email
 
         return self.render_template('user/edit_email.html', **params)
@@ -740,7 +745,7 @@ class EditEmailHandler(BaseHandler):
         password = self.form.password.data.strip()
 
         try:
-            user_info = models.User.get_by_id(long(self.user_id))
+            user_info = self.user_info
             auth_id = "own:%s" % user_info.username
             # Password to SHA512
             password = utils.hashing(password, config.salt)
@@ -965,6 +970,7 @@ class EmailChangedCompleteHandler(BaseHandler):
             user = verify[0]
             user.email = email
             user.put()
+            models.Article.update_owner(user)
             # delete token
             models.User.delete_auth_token(int(user_id), token)
             # add successful message and redirect
@@ -999,3 +1005,35 @@ class SecureRequestHandler(BaseHandler):
             return "Secure zone error:" + " %s." % e
 
 
+# JOB HANDLER
+# build the username, email and social identity lookups for users saved before we kept them,
+# a page at a time - users first, then social users
+class BuildLookupsHandler(BaseHandler):
+    kinds = {'User': models.User, 'SocialUser': models.SocialUser}
+
+    def get(self):
+        if self.request.get('job_token') != config.job_token:
+            logging.info("Hacker attack on jobs!")
+            return
+        else:
+            kind = self.request.get('kind', 'User')
+            if kind not in self.kinds:
+                logging.error("can't build lookups for %s." % kind)
+                return
+
+            entities, cursor = models.fetch_page(self.kinds[kind].query(), 100, self.request.get('cursor'))
+            models.Lookup.update_targets(entities)
+
+            # on to the next page, or the next kind
+            if cursor:
+                params = {'kind': kind, 'cursor': cursor, 'job_token': config.job_token}
+            elif kind == 'User':
+                params = {'kind': 'SocialUser', 'job_token': config.job_token}
+            else:
+                logging.info("done building lookups.")
+                return
+            taskqueue.add(method='GET', url='/users/buildlookups/', params=params)
+            return
+
+    def post(self):
+        self.get()